@@ -0,0 +1,409 @@
+import argparse
+import os
+import sys
+import json
+import time
+import random
+import struct
+import hashlib
+import tarfile
+import shutil
+import fnmatch
+import statistics
+import platform
+import contextlib
+import multiprocessing
+import concurrent.futures
+import wipt
+
+# Benchmark harness for wipt: generates synthetic boot images, AP archives and sparse images (no real firmware
+# needed), runs each case in a fresh process with an offline magiskboot stub, and writes wall/CPU time, throughput
+# and peak RSS as a JSON baseline that later runs can be compared against.
+
+BENCH_WORK_DIR = "bench_work" # Generated inputs are kept here and reused while their parameters match
+BENCH_OUTPUT = "bench_output.json"
+BENCH_SCHEMA = 1
+PATTERN_BLOCK_SIZE = 4 * 1024 * 1024
+PAGE = 4096
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+SUITES = { # Defaults per suite; --ap_sizes/--sparse_sizes override them
+    "quick": {"ap_sizes": ["100M"], "sparse_sizes": ["256M"]},
+    "full": {"ap_sizes": ["100M", "1G", "8G"], "sparse_sizes": ["256M", "4G"]},
+}
+AP_FILLER_PARTITIONS = ["system", "vendor", "product", "odm", "userdata"]
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]]) if text and text[-1] in SIZE_SUFFIXES else int(text)
+
+# --- Synthetic Data ---
+def pattern_block(size=PATTERN_BLOCK_SIZE, compressibility=0.5, seed=0):
+    """Deterministic filler: every 4 KiB page is random bytes followed by zeros, so roughly `compressibility` of
+    it compresses away (0 = incompressible, 1 = all zeros)."""
+    rnd, random_len = random.Random(seed), PAGE - int(PAGE * min(max(compressibility, 0.0), 1.0))
+    page_count = (size + PAGE - 1) // PAGE
+    return b"".join(rnd.randbytes(random_len) + bytes(PAGE - random_len) for _ in range(page_count))[:size]
+
+class PatternStream:
+    """Read-only file object yielding `size` bytes by cycling a pattern block, for writing large members without
+    holding them in memory."""
+    def __init__(self, size, block): self.remaining = size; self.block = block; self.pos = 0
+
+    def read(self, n=-1):
+        n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        parts, left = [], n
+        while left:
+            take = min(left, len(self.block) - self.pos)
+            parts.append(self.block[self.pos:self.pos + take]); self.pos = (self.pos + take) % len(self.block); left -= take
+        self.remaining -= n
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+def _pad(data, page_size): return data + bytes(-len(data) % page_size)
+
+def build_ramdisk(size, compressibility=0.5, fmt="gzip", seed=0):
+    """A newc ramdisk with an init, a few directories and 1 MiB files making up about `size` uncompressed bytes."""
+    block = pattern_block(1024 * 1024, compressibility, seed)
+    entries = {"init": [0o100750, 0, 0, 0, 0, block[:256 * 1024]], "system": [0o40755, 0, 0, 0, 0, b""],
+               "system/bin": [0o40755, 0, 0, 0, 0, b""], "first_stage_ramdisk": [0o40755, 0, 0, 0, 0, b""]}
+    remaining, i = size - len(entries["init"][5]), 0
+    while remaining > 0:
+        data = (block[i * 251:] + block[:i * 251])[:remaining] # Rotated so files differ
+        entries[f"system/bin/blob{i:04d}"] = [0o100644, 0, 0, 0, 0, data]; remaining -= len(data); i += 1
+    return wipt.compress_ramdisk(fmt, wipt.RamdiskCpio(entries).to_bytes())
+
+def build_boot_image(header_version, kernel, ramdisk, page_size=2048, second=b"", recovery_dtbo=b"", dtb=b"", signature=b""):
+    """A boot image with header v0-v4 laid out as mkbootimg does (v0-v2 with a SHA-1 id, v3/v4 on 4 KiB pages)."""
+    if header_version <= 2:
+        sections = [kernel, ramdisk, second] + ([recovery_dtbo] if header_version >= 1 else []) + ([dtb] if header_version >= 2 else [])
+        header = bytearray(page_size)
+        struct.pack_into('<8s10I', header, 0, wipt.BOOT_MAGIC, len(kernel), 0x8000, len(ramdisk), 0x1000000, len(second),
+                         0xF00000, 0x100, page_size, header_version, 0)
+        digest = hashlib.sha1()
+        for data in sections: digest.update(data); digest.update(struct.pack('<I', len(data)))
+        header[wipt.BOOT_ID_OFFSET:wipt.BOOT_ID_OFFSET + 32] = digest.digest().ljust(32, b"\0")
+        if header_version >= 1:
+            dtbo_offset = page_size + sum(len(_pad(data, page_size)) for data in sections[:3]) if recovery_dtbo else 0
+            struct.pack_into('<IQI', header, 1632, len(recovery_dtbo), dtbo_offset, 1660 if header_version == 2 else 1648)
+        if header_version == 2: struct.pack_into('<IQ', header, 1648, len(dtb), 0x1F00000)
+    else:
+        page_size, sections, header = wipt.BOOT_V3_PAGE_SIZE, [kernel, ramdisk] + ([signature] if header_version == 4 else []), bytearray(wipt.BOOT_V3_PAGE_SIZE)
+        struct.pack_into('<8s4I4II', header, 0, wipt.BOOT_MAGIC, len(kernel), len(ramdisk), 0, 1584 if header_version == 4 else 1580,
+                         0, 0, 0, 0, header_version)
+        if header_version == 4: struct.pack_into('<I', header, 1580, len(signature))
+    return bytes(header) + b"".join(_pad(data, page_size) for data in sections)
+
+def synthetic_boot_image(header_version, ramdisk_size, kernel_size=16 * 1024 * 1024, compressibility=0.5, seed=0):
+    """build_boot_image with generated sections: gzip ramdisks for v0-v2, lz4_legacy for v3/v4 (as GKI images)."""
+    kernel = pattern_block(kernel_size, compressibility, seed)
+    ramdisk = build_ramdisk(ramdisk_size, compressibility, "gzip" if header_version <= 2 else "lz4_legacy", seed + 1)
+    extras = {"recovery_dtbo": pattern_block(64 * 1024, compressibility, seed + 2) if header_version in (1, 2) else b"",
+              "dtb": pattern_block(256 * 1024, compressibility, seed + 3) if header_version == 2 else b"",
+              "signature": bytes(4096) if header_version == 4 else b""}
+    return build_boot_image(header_version, kernel, ramdisk, **extras)
+
+def write_ap_archive(path, total_size, members=64, boot_image=b"", boot_position="last", compressibility=0.5, lz4=False, seed=0):
+    """A Samsung-style AP tar (or tar.lz4) of about `total_size` bytes: `members` filler partitions plus boot.img and
+    vbmeta.img. The boot image goes last by default, the worst case for the streaming extractor."""
+    block, members = pattern_block(PATTERN_BLOCK_SIZE, compressibility, seed), max(1, members)
+    filler_size = max(0, total_size - len(boot_image) - (members + 2) * 1024) // members
+    small = [("boot.img", boot_image), ("vbmeta.img", pattern_block(8192, 0.9, seed + 1))]
+    def add_bytes(tar, name, data):
+        info = tarfile.TarInfo(name); info.size, info.mode, info.mtime = len(data), 0o644, 0
+        tar.addfile(info, PatternStream(len(data), data) if data else None)
+    with contextlib.ExitStack() as stack:
+        if lz4: tar = stack.enter_context(tarfile.open(fileobj=stack.enter_context(wipt.open_lz4(path, 'wb')), mode='w|', bufsize=wipt.LZ4_IO_CHUNK))
+        else: tar = stack.enter_context(tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT))
+        tar.copybufsize = wipt.LZ4_IO_CHUNK
+        if boot_position == "first": [add_bytes(tar, name, data) for name, data in small]
+        for i in range(members):
+            info = tarfile.TarInfo(f"{AP_FILLER_PARTITIONS[i % len(AP_FILLER_PARTITIONS)]}_{i:03d}.img.lz4")
+            info.size, info.mode, info.mtime = filler_size, 0o644, 0
+            tar.addfile(info, PatternStream(filler_size, block[i % 4096:] + block[:i % 4096]))
+        if boot_position != "first": [add_bytes(tar, name, data) for name, data in small]
+
+def write_sparse_image(path, total_size, compressibility=0.5, block_size=PAGE, seed=0):
+    """An Android sparse image streamed straight to disk: a repeating 32 MiB layout of RAW 8M, DONT_CARE 4M,
+    FILL 2M, RAW 2M, DONT_CARE 16M (10/32 data, like a mostly-empty filesystem)."""
+    block, layout = pattern_block(PATTERN_BLOCK_SIZE, compressibility, seed), [("raw", 8), ("dont_care", 4), ("fill", 2), ("raw", 2), ("dont_care", 16)]
+    total_blocks, blocks_per_mib, written, chunks = total_size // block_size, (1 << 20) // block_size, 0, 0
+    with open(path, 'wb') as f:
+        f.write(bytes(28))
+        while written < total_blocks:
+            for kind, mib in layout:
+                count = min(mib * blocks_per_mib, total_blocks - written)
+                if count <= 0: break
+                if kind == "raw":
+                    f.write(struct.pack('<HHII', wipt.SPARSE_CHUNK_RAW, 0, count, 12 + count * block_size))
+                    data = PatternStream(count * block_size, block[written % 4096:] + block[:written % 4096])
+                    for chunk in iter(lambda: data.read(PATTERN_BLOCK_SIZE), b""): f.write(chunk)
+                elif kind == "fill": f.write(struct.pack('<HHII', wipt.SPARSE_CHUNK_FILL, 0, count, 16) + b"\xa5\x5a\xa5\x5a")
+                else: f.write(struct.pack('<HHII', wipt.SPARSE_CHUNK_DONT_CARE, 0, count, 12))
+                written += count; chunks += 1
+        f.seek(0); f.write(struct.pack('<IHHHHIIII', wipt.SPARSE_HEADER_MAGIC, 1, 0, 28, 12, block_size, total_blocks, chunks, 0))
+
+# --- Offline magiskboot Stub ---
+MAGISK_ASSET_SIZES = {"magisk_arm64": 2 * 1024 * 1024, "magiskinit_arm64": 1024 * 1024, "initld_arm64": 64 * 1024, "stub.apk": 32 * 1024}
+STUB_MAGISKBOOT = '''#!{python}
+# Offline stand-in for magiskboot, written by bench_wipt.py: unpack/cpio/repack/xz on top of wipt's in-process engines.
+import lzma, os, sys
+sys.path.insert(0, {repo!r})
+import wipt
+
+def main(cmd, args):
+    if cmd == "xz":
+        with open(args[0], 'rb') as f_in, open(args[1], 'wb') as f_out: f_out.write(lzma.compress(f_in.read(), check=lzma.CHECK_CRC32, preset=9))
+    elif cmd == "unpack":
+        with wipt.BootImage(args[0]) as img:
+            written = img.unpack(".")
+            fmt = wipt.detect_ramdisk_format(img.sections["ramdisk"])
+            with open("ramdisk.cpio", 'wb') as f: f.write(wipt.decompress_ramdisk(fmt, img.sections["ramdisk"]))
+            if "ramdisk" in written: os.remove(written["ramdisk"])
+    elif cmd == "cpio":
+        ramdisk = wipt.RamdiskCpio.load(args[0])
+        for c in args[1:]: ramdisk.apply(c)
+        ramdisk.dump(args[0])
+    elif cmd == "repack":
+        with wipt.BootImage(args[0]) as img, open("ramdisk.cpio", 'rb') as f:
+            fmt = wipt.detect_ramdisk_format(img.sections["ramdisk"])
+            img.write(args[1] if len(args) > 1 else "new-boot.img", {{"ramdisk": wipt.compress_ramdisk(fmt, f.read())}})
+    else: print(f"stub magiskboot: unsupported command {{cmd}}", file=sys.stderr); return 1
+    return 0
+
+if __name__ == "__main__": sys.exit(main(sys.argv[1], sys.argv[2:]))
+'''
+
+def prepare_workspace(work_dir):
+    """Creates work_dir/vendor/magisk-assets with synthetic Magisk binaries and the magiskboot stub. Patch cases run
+    with work_dir as the current directory, where wipt looks for its assets."""
+    assets = os.path.join(work_dir, "vendor", "magisk-assets"); os.makedirs(assets, exist_ok=True)
+    for i, (name, size) in enumerate(MAGISK_ASSET_SIZES.items()):
+        path = os.path.join(assets, name)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, 'wb') as f: f.write(pattern_block(size, 0.4, 100 + i))
+    stub_path = os.path.join(assets, "magiskboot")
+    with open(stub_path, 'w', newline='\n') as f: f.write(STUB_MAGISKBOOT.format(python=sys.executable, repo=os.path.dirname(os.path.abspath(wipt.__file__))))
+    os.chmod(stub_path, 0o755)
+    return assets
+
+def _write_bytes(path, data):
+    with open(path, 'wb') as f: f.write(data)
+
+def _generate(path, params, writer):
+    """Runs writer(path) unless path exists with a sidecar recording the same params. Returns the path."""
+    sidecar = path + ".params.json"
+    try:
+        with open(sidecar, encoding='utf-8') as f:
+            if json.load(f) == params and os.path.exists(path): return path
+    except (OSError, ValueError): pass
+    print(f"Generating {path} ({params})...", flush=True); start = time.perf_counter()
+    writer(path)
+    with open(sidecar, 'w', encoding='utf-8') as f: json.dump(params, f)
+    print(f"Generated {path}: {os.path.getsize(path) / 2**20:.1f} MiB in {time.perf_counter() - start:.1f}s", flush=True)
+    return path
+
+# --- Cases ---
+def build_cases(args):
+    """Returns [{name, kind, input, options}] for the selected suite, generating (or reusing) every input."""
+    suite, inputs, cases = SUITES[args.suite], os.path.join(args.work_dir, "inputs"), []
+    os.makedirs(inputs, exist_ok=True)
+    ramdisk_size, members, comp = args.ramdisk_mb * 1024 * 1024, args.members, args.compressibility
+    options = {"TARGET_ARCH": "arm64", "XZ_CACHE": args.warm_caches, "UNPACK_CACHE": args.warm_caches}
+    for version in range(5):
+        params = {"kind": "boot", "header_version": version, "ramdisk_size": ramdisk_size, "compressibility": comp}
+        path = _generate(os.path.join(inputs, f"boot_v{version}.img"), params,
+                         lambda p, v=version: _write_bytes(p, synthetic_boot_image(v, ramdisk_size, compressibility=comp)))
+        cases.append({"name": f"boot_v{version}", "kind": "patch", "input": path, "options": options})
+    if os.name != 'nt': # The stub is a Python script with a shebang
+        cases.append({"name": "boot_v4_magiskboot", "kind": "patch", "input": os.path.join(inputs, "boot_v4.img"),
+                      "options": dict(options, BOOTIMG_ENGINE="magiskboot", CPIO_ENGINE="magiskboot", XZ_ENGINE="magiskboot")})
+    boot_image = None
+    for size_text in args.ap_sizes or suite["ap_sizes"]:
+        size = parse_size(size_text)
+        for lz4 in (False, True):
+            name = f"ap_tar{'_lz4' if lz4 else ''}_{size_text}"
+            params = {"kind": "ap", "size": size, "members": members, "lz4": lz4, "boot_position": args.boot_position,
+                      "ramdisk_size": ramdisk_size, "compressibility": comp}
+            def writer(p, size=size, lz4=lz4):
+                nonlocal boot_image
+                boot_image = boot_image or synthetic_boot_image(2, ramdisk_size, compressibility=comp)
+                write_ap_archive(p, size, members, boot_image, args.boot_position, comp, lz4)
+            path = _generate(os.path.join(inputs, f"AP_bench_{size_text}.tar{'.lz4' if lz4 else ''}"), params, writer)
+            cases.append({"name": name, "kind": "patch", "input": path, "options": options})
+    for size_text in args.sparse_sizes or suite["sparse_sizes"]:
+        size = parse_size(size_text)
+        params = {"kind": "sparse", "size": size, "compressibility": comp}
+        path = _generate(os.path.join(inputs, f"sparse_{size_text}.img"), params, lambda p, size=size: write_sparse_image(p, size, comp))
+        cases.append({"name": f"sparse_{size_text}", "kind": "unsparse", "input": path, "options": {}})
+    if args.cases: cases = [case for case in cases if any(fnmatch.fnmatch(case["name"], pattern) for pattern in args.cases.split(","))]
+    return cases
+
+def _aggregate_stages(records):
+    stages = {}
+    for rec in records:
+        agg = stages.setdefault(rec["stage"], {"wall_s": 0.0, "cpu_s": 0.0, "bytes_in": 0, "bytes_out": 0})
+        agg["wall_s"] += rec.get("wall_s", 0); agg["cpu_s"] += rec.get("cpu_s", 0)
+        agg["bytes_in"] += rec.get("bytes_in") or 0; agg["bytes_out"] += rec.get("bytes_out") or 0
+    for agg in stages.values(): agg["mib_s"] = round(max(agg["bytes_in"], agg["bytes_out"]) / 2**20 / agg["wall_s"], 2) if agg["wall_s"] else None
+    return stages
+
+def run_case(case, work_dir, log_path):
+    """Runs one case in the current process (a fresh worker per run) and returns its measurements. wipt's output
+    goes to log_path."""
+    os.chdir(work_dir)
+    output_dir = os.path.join(work_dir, "output", case["name"])
+    wipt.PROFILER.enable(None, job=case["name"])
+    timings, start = {}, time.perf_counter()
+    with open(log_path, 'a', encoding='utf-8') as log, contextlib.redirect_stdout(log):
+        try:
+            if case["kind"] == "patch": wipt.run_patch_pipeline(case["input"], output_dir, "magisk", dict(case["options"]), timings)
+            else:
+                os.makedirs(output_dir, exist_ok=True)
+                with wipt.PROFILER.stage("unsparse", bytes_in=os.path.getsize(case["input"])) as rec:
+                    raw_path = os.path.join(output_dir, "raw.img"); wipt.unsparse_image(case["input"], raw_path)
+                    rec["bytes_out"] = os.path.getsize(raw_path)
+        finally: shutil.rmtree(output_dir, ignore_errors=True)
+    stages = _aggregate_stages(wipt.PROFILER.records)
+    for name, seconds in timings.items(): stages.setdefault(name, {"wall_s": seconds})
+    return {"total_wall_s": round(time.perf_counter() - start, 6), "stages": stages, "magiskboot_calls": wipt.MAGISKBOOT_RUNNER.calls,
+            "peak_rss_kb": wipt._peak_rss_kb(wipt.resource.RUSAGE_SELF) if wipt.resource else None,
+            "peak_child_rss_kb": wipt._peak_rss_kb(wipt.resource.RUSAGE_CHILDREN) if wipt.resource else None}
+
+def _run_isolated(case, work_dir, log_path):
+    """Peak RSS is a per-process high-water mark, so every run gets its own spawned interpreter."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_case, case, work_dir, log_path).result()
+
+def summarize_runs(case, runs):
+    """Median wall/CPU time per stage and in total, max peak RSS, across repeated runs of one case."""
+    stages = {}
+    for name in runs[0]["stages"]:
+        samples = [run["stages"][name] for run in runs if name in run["stages"]]
+        stage = dict(samples[0])
+        for key in ("wall_s", "cpu_s"):
+            if key in stage: stage[key] = round(statistics.median(s[key] for s in samples), 6)
+        if stage.get("bytes_in") is not None and stage["wall_s"]:
+            stage["mib_s"] = round(max(stage["bytes_in"], stage["bytes_out"]) / 2**20 / stage["wall_s"], 2)
+        stages[name] = stage
+    peaks = [run["peak_rss_kb"] for run in runs if run["peak_rss_kb"] is not None]
+    total = statistics.median(run["total_wall_s"] for run in runs)
+    input_bytes = os.path.getsize(case["input"])
+    return {"kind": case["kind"], "input": os.path.basename(case["input"]), "input_bytes": input_bytes, "runs": len(runs),
+            "total_wall_s": round(total, 6), "total_mib_s": round(input_bytes / 2**20 / total, 2) if total else None,
+            "peak_rss_kb": max(peaks) if peaks else None, "magiskboot_calls": runs[0]["magiskboot_calls"],
+            "run_wall_s": [run["total_wall_s"] for run in runs], "stages": stages}
+
+def format_results(results):
+    lines = [f"{'case':<24} {'MiB in':>9} {'total s':>9} {'MiB/s':>8} {'peak RSS MiB':>12}  stages (wall s)"]
+    for name, res in results["cases"].items():
+        stages = ", ".join(f"{stage} {s['wall_s']:.3f}" for stage, s in res["stages"].items())
+        peak = f"{res['peak_rss_kb'] / 1024:.1f}" if res["peak_rss_kb"] is not None else "n/a"
+        lines.append(f"{name:<24} {res['input_bytes'] / 2**20:>9.1f} {res['total_wall_s']:>9.3f} {res['total_mib_s'] or 0:>8.1f} {peak:>12}  {stages}")
+    return "\n".join(lines)
+
+# --- Baseline Comparison ---
+def compare_results(baseline, current, threshold=0.15, min_delta_s=0.05, min_delta_rss_kb=4096):
+    """Compares total and per-stage wall time and peak RSS for the cases present in both result sets. A metric
+    regresses when it grows by more than `threshold` (a fraction) and by more than the absolute floor, which keeps
+    millisecond stages from flagging on noise. Returns (lines, regression_count)."""
+    lines, regressions = [], 0
+    for name in sorted(set(baseline["cases"]) | set(current["cases"])):
+        base, cur = baseline["cases"].get(name), current["cases"].get(name)
+        if not base or not cur: lines.append(f"{name}: only in {'current' if cur else 'baseline'}"); continue
+        metrics = [("total_wall_s", base["total_wall_s"], cur["total_wall_s"], min_delta_s)]
+        metrics += [(f"{stage} wall_s", s["wall_s"], cur["stages"][stage]["wall_s"], min_delta_s) for stage, s in base["stages"].items() if stage in cur["stages"]]
+        if base.get("peak_rss_kb") and cur.get("peak_rss_kb"): metrics.append(("peak_rss_kb", base["peak_rss_kb"], cur["peak_rss_kb"], min_delta_rss_kb))
+        for metric, old, new, floor in metrics:
+            change = (new - old) / old if old else 0.0
+            status = "REGRESSION" if change > threshold and new - old > floor else "improved" if change < -threshold and old - new > floor else "ok"
+            regressions += status == "REGRESSION"
+            lines.append(f"{name:<24} {metric:<32} {old:>12.3f} -> {new:>12.3f} {change:>+8.1%}  {status}")
+    return lines, regressions
+
+def _load_results(path):
+    with open(path, encoding='utf-8') as f: results = json.load(f)
+    if results.get("schema") != BENCH_SCHEMA: raise ValueError(f"Unsupported benchmark results schema {results.get('schema')}: {path}")
+    return results
+
+def _print_comparison(baseline, current, args):
+    lines, regressions = compare_results(baseline, current, args.threshold, args.min_delta_s)
+    print("\n--- Comparison ---\n" + "\n".join(lines))
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+# --- Main CLI Handling ---
+def handle_run(args):
+    work_dir = os.path.abspath(args.work_dir); os.makedirs(work_dir, exist_ok=True)
+    prepare_workspace(work_dir)
+    cases = build_cases(args)
+    log_path = os.path.join(work_dir, "bench.log")
+    results = {"schema": BENCH_SCHEMA, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+               "host": {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()},
+               "settings": {"suite": args.suite, "repeat": args.repeat, "ramdisk_mb": args.ramdisk_mb, "members": args.members,
+                            "compressibility": args.compressibility, "boot_position": args.boot_position, "warm_caches": args.warm_caches},
+               "cases": {}}
+    for case in cases:
+        print(f"Running {case['name']} ({os.path.getsize(case['input']) / 2**20:.1f} MiB, {args.repeat} run(s))...", flush=True)
+        try: runs = [_run_isolated(case, work_dir, log_path) for _ in range(args.repeat)]
+        except Exception as e: print(f"Case {case['name']} failed: {e} (see {log_path})"); continue
+        results["cases"][case["name"]] = summarize_runs(case, runs)
+        res = results["cases"][case["name"]]
+        print(f"  {res['total_wall_s']:.3f}s, {res['total_mib_s'] or 0:.1f} MiB/s, peak RSS {(res['peak_rss_kb'] or 0) / 1024:.1f} MiB", flush=True)
+    with open(args.output, 'w', encoding='utf-8') as f: json.dump(results, f, indent=2)
+    print("\n" + format_results(results) + f"\n\nResults written to {args.output}")
+    if args.compare: return _print_comparison(_load_results(args.compare), results, args)
+    return 0
+
+def handle_compare(args): return _print_comparison(_load_results(args.baseline), _load_results(args.current), args)
+
+def handle_generate(args):
+    size = parse_size(args.size) if args.size else None
+    if args.kind == "boot":
+        _write_bytes(args.output, synthetic_boot_image(args.header_version, args.ramdisk_mb * 1024 * 1024, compressibility=args.compressibility))
+    elif args.kind in ("tar", "tar.lz4"):
+        boot_image = synthetic_boot_image(args.header_version, args.ramdisk_mb * 1024 * 1024, compressibility=args.compressibility)
+        write_ap_archive(args.output, size or parse_size("100M"), args.members, boot_image, args.boot_position, args.compressibility, args.kind == "tar.lz4")
+    else: write_sparse_image(args.output, size or parse_size("256M"), args.compressibility)
+    print(f"Wrote {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MiB)")
+    return 0
+
+def _add_data_arguments(parser):
+    parser.add_argument("--ramdisk_mb", type=int, default=8, help="Uncompressed ramdisk size of generated boot images, MiB. Default: 8.")
+    parser.add_argument("--members", type=int, default=64, help="Filler members in generated AP archives. Default: 64.")
+    parser.add_argument("--compressibility", type=float, default=0.5, help="Fraction of generated data that is zeros (0-1). Default: 0.5.")
+    parser.add_argument("--boot_position", type=str, default="last", choices=["first", "last"], help="Where boot.img sits in AP archives. Default: last.")
+
+def _add_compare_arguments(parser):
+    parser.add_argument("--threshold", type=float, default=0.15, help="Relative slowdown (or RSS growth) flagged as a regression. Default: 0.15.")
+    parser.add_argument("--min_delta_s", type=float, default=0.05, help="Ignore wall-time changes smaller than this many seconds. Default: 0.05.")
+
+def main():
+    parser = argparse.ArgumentParser(description="WIPT benchmark harness (synthetic inputs, offline magiskboot stub)")
+    subparsers = parser.add_subparsers(title="Commands", dest="command", required=True)
+    parser_run = subparsers.add_parser("run", help="Generate inputs, run the benchmark cases and write JSON results.")
+    parser_run.add_argument("--suite", type=str, default="quick", choices=list(SUITES), help="Case sizes. quick: 100M AP, 256M sparse; full: up to 8G. Default: quick.")
+    parser_run.add_argument("--ap_sizes", type=lambda s: [x.strip() for x in s.split(",") if x.strip()], default=None, help="Comma-separated AP archive sizes, e.g. 100M,1G.")
+    parser_run.add_argument("--sparse_sizes", type=lambda s: [x.strip() for x in s.split(",") if x.strip()], default=None, help="Comma-separated sparse image sizes.")
+    parser_run.add_argument("--cases", type=str, default=None, help="Comma-separated case name patterns to run, e.g. 'boot_*,ap_tar_lz4_*'.")
+    parser_run.add_argument("--repeat", type=int, default=3, help="Runs per case; stage times are medians. Default: 3.")
+    parser_run.add_argument("--warm_caches", action="store_true", help="Keep the XZ and unpack caches on (measures warm runs after the first).")
+    parser_run.add_argument("--work_dir", type=str, default=BENCH_WORK_DIR, help=f"Generated inputs, assets and logs. Default: {BENCH_WORK_DIR}.")
+    parser_run.add_argument("--output", type=str, default=BENCH_OUTPUT, help=f"Results file. Default: {BENCH_OUTPUT}.")
+    parser_run.add_argument("--compare", type=str, default=None, help="Baseline results to compare against; exits 1 on regressions.")
+    _add_data_arguments(parser_run); _add_compare_arguments(parser_run)
+    parser_run.set_defaults(func=handle_run)
+    parser_compare = subparsers.add_parser("compare", help="Compare two results files; exits 1 on regressions.")
+    parser_compare.add_argument("baseline"); parser_compare.add_argument("current")
+    _add_compare_arguments(parser_compare)
+    parser_compare.set_defaults(func=handle_compare)
+    parser_generate = subparsers.add_parser("generate", help="Write one synthetic input.")
+    parser_generate.add_argument("--kind", type=str, required=True, choices=["boot", "tar", "tar.lz4", "sparse"])
+    parser_generate.add_argument("--output", required=True)
+    parser_generate.add_argument("--size", type=str, default=None, help="Archive or sparse image size, e.g. 1G.")
+    parser_generate.add_argument("--header_version", type=int, default=2, choices=range(5), help="Boot image header version. Default: 2.")
+    _add_data_arguments(parser_generate)
+    parser_generate.set_defaults(func=handle_generate)
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,12 @@ import requests
 import zipfile
 import shutil
 import stat # For setting executable permissions if needed
+import argparse
+import hashlib
+import json
+import threading
+import concurrent.futures
+from wipt_assets import ASSET_MANIFEST_NAME, load_asset_manifest # Shared with wipt.py; importing wipt here would pull in lz4 and friends
 
 # --- Constants ---
 MAGISK_API_URL = "https://api.github.com/repos/topjohnwu/Magisk/releases/latest"
@@ -40,65 +46,225 @@ COMMON_ASSETS_FROM_APK = {
 }
 
 
+# --- Asset Manager ---
+ASSET_STATE_FILE = "assets_state.json" # In the asset dir: release tag/ETag and, per file, URL, tag, ETag, size, SHA-256
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_JOBS = 4
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""): digest.update(chunk)
+    return digest.hexdigest()
+
+def _content_range_start(response):
+    """First byte offset of a 206 response ('bytes 100-199/200'), or None."""
+    value = response.headers.get("Content-Range", "")
+    try: return int(value.split()[1].split("-")[0]) if value.startswith("bytes ") else None
+    except (IndexError, ValueError): return None
+
+class AssetManager:
+    """Downloads release assets into asset_dir and remembers what each file was fetched from (ASSET_STATE_FILE).
+    A file is skipped when it is present and its SHA-256 matches the published digest or, without one, the digest
+    recorded for the same URL. Interrupted downloads stay as <name>.part and resume with an HTTP Range request
+    (If-Range on the saved ETag, so a changed file restarts from zero). fetch_all downloads several files at once."""
+    def __init__(self, asset_dir, jobs=DOWNLOAD_JOBS, timeout=30, force=False):
+        self.asset_dir = asset_dir; self.jobs = jobs; self.timeout = timeout; self.force = force
+        self.state_path = os.path.join(asset_dir, ASSET_STATE_FILE)
+        self.lock = threading.Lock()
+        self.requests_made, self.bytes_downloaded = 0, 0
+        try:
+            with open(self.state_path, encoding='utf-8') as f: self.state = json.load(f)
+        except (OSError, ValueError): self.state = {}
+        self.state.setdefault("files", {})
+
+    def save_state(self):
+        with self.lock:
+            os.makedirs(self.asset_dir, exist_ok=True)
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(self.state, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+    def _count(self, requests_made=0, bytes_downloaded=0):
+        with self.lock: self.requests_made += requests_made; self.bytes_downloaded += bytes_downloaded
+
+    def fetch_release(self, api_url, offline=False):
+        """Returns the release JSON (tag_name and assets). The request carries If-None-Match with the stored ETag, so
+        an unchanged release answers 304 with no body and the stored copy is used; it is also used when offline or
+        when the request fails."""
+        cached = self.state.get("release") if (self.state.get("release") or {}).get("api_url") == api_url else None
+        if offline:
+            if not cached: print("Error: --offline given but no release info is cached.")
+            return cached["json"] if cached else None
+        headers = {"Accept": "application/vnd.github+json"}
+        if cached and cached.get("etag") and not self.force: headers["If-None-Match"] = cached["etag"]
+        try:
+            response = requests.get(api_url, headers=headers, timeout=10); self._count(requests_made=1)
+            if response.status_code == 304:
+                print(f"Release info unchanged (tag {cached['json'].get('tag_name')}, ETag {cached['etag']})."); return cached["json"]
+            response.raise_for_status()
+            release = response.json()
+            assets = [{key: a.get(key) for key in ("name", "size", "browser_download_url", "digest")} for a in release.get("assets", [])]
+            self.state["release"] = {"api_url": api_url, "etag": response.headers.get("ETag"), "json": {"tag_name": release.get("tag_name"), "assets": assets}}
+            self.save_state()
+            return self.state["release"]["json"]
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error fetching release info from {api_url}: {e}")
+            if cached: print("Using the cached release info."); return cached["json"]
+        return None
+
+    def is_current(self, name, url, size=None, sha256=None):
+        path, entry = os.path.join(self.asset_dir, name), self.state["files"].get(name) or {}
+        if self.force or not os.path.exists(path) or (size is not None and os.path.getsize(path) != size): return False
+        expected = sha256 or (entry.get("sha256") if entry.get("url") == url else None)
+        return bool(expected) and sha256_file(path) == expected
+
+    def download(self, name, url, size=None, sha256=None, tag=None):
+        """Fetches url to asset_dir/name unless it is already current. Returns the path, or None on failure (a
+        partial download is kept for the next run to resume)."""
+        path = os.path.join(self.asset_dir, name)
+        if self.is_current(name, url, size, sha256): print(f"Up to date: {name}" + (f" ({tag})" if tag else "")); return path
+        os.makedirs(self.asset_dir, exist_ok=True)
+        part_path, part_meta_path = path + ".part", path + ".part.json"
+        try:
+            with open(part_meta_path, encoding='utf-8') as f: part_meta = json.load(f)
+        except (OSError, ValueError): part_meta = {}
+        offset = os.path.getsize(part_path) if part_meta.get("url") == url and os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-", **({"If-Range": part_meta["etag"]} if part_meta.get("etag") else {})} if offset else {}
+        print(f"Downloading {url} to {path}" + (f" (resuming at {offset} bytes)" if offset else "") + "...")
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                self._count(requests_made=1)
+                if response.status_code == 416 and size is not None and offset == size:
+                    print(f"  {name}: partial download is already complete, finalizing"); etag = part_meta.get("etag")
+                elif response.status_code == 416:
+                    print(f"  {name}: 416 Range Not Satisfiable, discarding the partial download and restarting from byte 0")
+                    for p in (part_path, part_meta_path):
+                        if os.path.exists(p): os.remove(p)
+                    return self.download(name, url, size, sha256, tag)
+                else:
+                    response.raise_for_status()
+                    resumed = offset > 0 and response.status_code == 206 and _content_range_start(response) == offset
+                    if offset and not resumed: print(f"  {name}: server sent the whole file (changed or no Range support), restarting")
+                    with open(part_meta_path, 'w', encoding='utf-8') as f: json.dump({"url": url, "etag": response.headers.get("ETag")}, f)
+                    with open(part_path, 'ab' if resumed else 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE): f.write(chunk); self._count(bytes_downloaded=len(chunk))
+                    etag = response.headers.get("ETag") or part_meta.get("etag")
+        except requests.exceptions.RequestException as e:
+            print(f"Error downloading {url}: {e}")
+            if offset == 0 and os.path.exists(part_path) and not os.path.getsize(part_path): os.remove(part_path)
+            return None
+        except IOError as e: print(f"Error writing to {part_path}: {e}"); return None
+        actual_size = os.path.getsize(part_path)
+        if size is not None and actual_size < size: print(f"Error: {name} is incomplete ({actual_size} of {size} bytes); rerun to resume."); return None
+        digest = sha256_file(part_path)
+        if (size is not None and actual_size != size) or (sha256 and digest != sha256):
+            print(f"Error: {name} does not match the release (size {actual_size}, SHA-256 {digest}); discarded.")
+            for p in (part_path, part_meta_path):
+                if os.path.exists(p): os.remove(p)
+            return None
+        os.replace(part_path, path)
+        if os.path.exists(part_meta_path): os.remove(part_meta_path)
+        with self.lock: self.state["files"][name] = {"url": url, "tag": tag, "etag": etag, "size": actual_size, "sha256": digest}
+        self.save_state()
+        print(f"Downloaded {name} ({actual_size} bytes, SHA-256 {digest}).")
+        return path
+
+    def fetch_all(self, items):
+        """Downloads items (dicts with name, url and optional size, sha256, tag) concurrently. Returns name -> path or None."""
+        if not items: return {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.jobs, len(items)))) as pool:
+            futures = {item["name"]: pool.submit(self.download, **item) for item in items}
+        return {name: future.result() for name, future in futures.items()}
+
+    def summary(self): return f"Asset manager: {self.requests_made} request(s), {self.bytes_downloaded / 2**20:.1f} MiB downloaded"
+
 # --- Helper Functions ---
 def download_file(url, destination):
-    print(f"Downloading {url} to {destination}...")
-    try:
-        response = requests.get(url, stream=True, timeout=30)
-        response.raise_for_status()
-        os.makedirs(os.path.dirname(destination), exist_ok=True)
-        with open(destination, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192): f.write(chunk)
-        print("Download successful.")
-        return True
-    except requests.exceptions.RequestException as e: print(f"Error downloading {url}: {e}")
-    except IOError as e: print(f"Error writing to {destination}: {e}")
-    return False
+    """Downloads one file through AssetManager (resumable, skipped when already current). Returns True on success."""
+    return AssetManager(os.path.dirname(destination) or ".").download(os.path.basename(destination), url) is not None
+
+def release_asset_sha256(asset):
+    digest = asset.get("digest") or "" # GitHub publishes "sha256:<hex>" for release assets
+    return digest.split(":", 1)[1] if digest.startswith("sha256:") else None
+
+# --- APK Extraction ---
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+EXTRACT_JOBS = 4
+
+def index_apk_assets(apk_zip, archs):
+    """One pass over the central directory: returns [(ZipInfo, target_filename, arch or None)] for the
+    arch-specific libraries of `archs` and the common assets. Nothing missing is probed for."""
+    lib_dirs = {apk_lib_path_segment: short_arch for short_arch, apk_lib_path_segment in TARGET_ARCHITECTURES.items() if short_arch in archs}
+    index = []
+    for info in apk_zip.infolist():
+        parts = info.filename.split("/")
+        if len(parts) == 3 and parts[0] == "lib" and parts[1] in lib_dirs and parts[2] in ARCH_SPECIFIC_ASSETS_FROM_APK:
+            arch = lib_dirs[parts[1]]
+            index.append((info, f"{ARCH_SPECIFIC_ASSETS_FROM_APK[parts[2]]}_{arch}", arch)) # e.g., magiskinit_arm64
+        elif info.filename in COMMON_ASSETS_FROM_APK: index.append((info, COMMON_ASSETS_FROM_APK[info.filename], None))
+    return index
+
+def _extract_member(apk_zip, info, target_path, executable):
+    """Streams one member to target_path in bounded chunks (via a temp file), hashing as it goes. Returns (sha256, size)."""
+    digest, size, tmp_path = hashlib.sha256(), 0, target_path + ".tmp"
+    with apk_zip.open(info) as src, open(tmp_path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(EXTRACT_CHUNK_SIZE), b""): digest.update(chunk); dst.write(chunk); size += len(chunk)
+    if executable and os.name != 'nt':
+        os.chmod(tmp_path, os.stat(tmp_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.replace(tmp_path, target_path)
+    return digest.hexdigest(), size
 
-def extract_assets_from_apk_refined(apk_path, target_dir):
-    print(f"Extracting assets from {apk_path} to {target_dir}...")
-    extracted_count = 0
+def manifest_is_current(manifest, apk_sha256, archs, target_dir):
+    """True when the manifest came from this APK, covers every requested arch, and its files are present at the
+    recorded sizes."""
+    if not manifest or manifest.get("apk_sha256") != apk_sha256 or not set(archs) <= set(manifest.get("archs", [])): return False
+    for name, entry in manifest.get("assets", {}).items():
+        try:
+            if os.path.getsize(os.path.join(target_dir, name)) != entry["size"]: return False
+        except OSError: return False
+    return True
+
+def extract_assets_from_apk_refined(apk_path, target_dir, archs=None, version=None, jobs=EXTRACT_JOBS):
+    """Extracts the assets for `archs` (default: all TARGET_ARCHITECTURES) plus the common assets from the APK,
+    streaming members to disk in parallel, and writes ASSET_MANIFEST_NAME (version, arch, sha256 and size per file).
+    Entries for other archs from a previous extraction of the same APK are kept while their files are intact.
+    Returns True if anything was extracted."""
+    archs = list(archs or TARGET_ARCHITECTURES)
+    print(f"Extracting assets for {', '.join(archs)} from {apk_path} to {target_dir}...")
     try:
+        apk_sha256 = sha256_file(apk_path)
         with zipfile.ZipFile(apk_path, 'r') as apk_zip:
-            # 1. Extract architecture-specific assets
-            for short_arch_name, apk_lib_path_segment in TARGET_ARCHITECTURES.items():
-                for asset_orig_name, asset_target_pattern in ARCH_SPECIFIC_ASSETS_FROM_APK.items():
-                    source_path_in_apk = f"lib/{apk_lib_path_segment}/{asset_orig_name}"
-                    target_filename = f"{asset_target_pattern}_{short_arch_name}" # e.g., magiskinit_arm64
-                    full_target_path = os.path.join(target_dir, target_filename)
-
-                    print(f"  Attempting: {source_path_in_apk} -> {target_filename}")
+            index = index_apk_assets(apk_zip, archs)
+            for short_arch in archs:
+                if not any(arch == short_arch for _, _, arch in index): print(f"  Info: No assets for {short_arch} in APK.")
+            os.makedirs(target_dir, exist_ok=True)
+            results = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(index) or 1))) as pool: # ZipFile reads are serialised per member seek; inflate runs in parallel
+                futures = {target: (info, arch, pool.submit(_extract_member, apk_zip, info, os.path.join(target_dir, target), arch is not None))
+                           for info, target, arch in index}
+                for target, (info, arch, future) in futures.items():
                     try:
-                        file_data = apk_zip.read(source_path_in_apk)
-                        with open(full_target_path, 'wb') as f_out: f_out.write(file_data)
-                        print(f"    Successfully extracted to {full_target_path}")
-                        extracted_count += 1
-                        # Set executable permissions if not on Windows
-                        if os.name != 'nt':
-                            try:
-                                current_mode = os.stat(full_target_path).st_mode
-                                os.chmod(full_target_path, current_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-                                print(f"    Set executable permission for {target_filename}")
-                            except Exception as e_perm: print(f"    Warning: Could not set executable for {target_filename}: {e_perm}")
-                    except KeyError: print(f"    Info: Asset {source_path_in_apk} not found in APK (normal for some arch/asset combos).")
-                    except Exception as e_extract: print(f"    Error extracting {source_path_in_apk}: {e_extract}")
-
-            # 2. Extract common assets
-            for source_path_in_apk, target_filename in COMMON_ASSETS_FROM_APK.items():
-                full_target_path = os.path.join(target_dir, target_filename)
-                print(f"  Attempting common asset: {source_path_in_apk} -> {target_filename}")
-                try:
-                    file_data = apk_zip.read(source_path_in_apk)
-                    with open(full_target_path, 'wb') as f_out: f_out.write(file_data)
-                    print(f"    Successfully extracted to {full_target_path}")
-                    extracted_count += 1
-                except KeyError: print(f"    Warning: Common asset {source_path_in_apk} not found in APK.")
-                except Exception as e_extract: print(f"    Error extracting common asset {source_path_in_apk}: {e_extract}")
-
-        if extracted_count > 0: print("Extraction process completed.")
-        else: print("No assets were successfully extracted from the APK based on the defined maps.")
-        return extracted_count > 0
-
+                        sha256, size = future.result()
+                        results[target] = {"arch": arch, "source": info.filename, "sha256": sha256, "size": size}
+                        print(f"  {info.filename} -> {target} ({size} bytes)")
+                    except Exception as e_extract: print(f"  Error extracting {info.filename}: {e_extract}")
+        missing_common = set(COMMON_ASSETS_FROM_APK.values()) - set(results)
+        if missing_common: print(f"  Warning: Common asset(s) not found in APK: {', '.join(sorted(missing_common))}")
+        if not results: print("No assets were successfully extracted from the APK based on the defined maps."); return False
+        previous = load_asset_manifest(target_dir)
+        assets = {}
+        if previous and previous.get("apk_sha256") == apk_sha256:
+            assets = {name: entry for name, entry in previous.get("assets", {}).items()
+                      if entry.get("arch") not in archs and os.path.exists(os.path.join(target_dir, name))}
+        assets.update(results)
+        manifest = {"version": version, "apk_sha256": apk_sha256, "archs": sorted({entry["arch"] for entry in assets.values() if entry["arch"]} | set(archs)),
+                    "assets": dict(sorted(assets.items()))}
+        tmp_path = os.path.join(target_dir, ASSET_MANIFEST_NAME + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(target_dir, ASSET_MANIFEST_NAME))
+        print(f"Extraction process completed: {len(results)} file(s); manifest written to {os.path.join(target_dir, ASSET_MANIFEST_NAME)}")
+        return True
     except zipfile.BadZipFile: print(f"Error: {apk_path} is not a valid zip file.")
     except FileNotFoundError: print(f"Error: APK file {apk_path} not found.")
     except Exception as e_zip_open: print(f"Error opening/processing APK {apk_path}: {e_zip_open}")
@@ -106,49 +272,62 @@ def extract_assets_from_apk_refined(apk_path, target_dir):
 
 # --- Main Setup Logic ---
 def main():
+    parser = argparse.ArgumentParser(description="WIPT setup: fetch Magisk assets")
+    parser.add_argument("--asset_dir", type=str, default=ASSET_DIR, help=f"Where assets are stored. Default: {ASSET_DIR}.")
+    parser.add_argument("--api_url", type=str, default=os.environ.get("WIPT_MAGISK_API_URL", MAGISK_API_URL), help="Magisk release API URL (env WIPT_MAGISK_API_URL).")
+    parser.add_argument("--magiskboot_url", type=str, default=os.environ.get("WIPT_MAGISKBOOT_URL", MAGISKBOOT_WINDOWS_URL), help="magiskboot.exe URL, Windows only (env WIPT_MAGISKBOOT_URL).")
+    parser.add_argument("--arch", type=str, default=",".join(TARGET_ARCHITECTURES), help=f"Comma-separated archs to extract ({', '.join(TARGET_ARCHITECTURES)}). Default: all.")
+    parser.add_argument("--jobs", type=int, default=DOWNLOAD_JOBS, help=f"Concurrent downloads and extraction threads. Default: {DOWNLOAD_JOBS}.")
+    parser.add_argument("--offline", action="store_true", help="Use the cached release info; download nothing that isn't already present.")
+    parser.add_argument("--force", action="store_true", help="Ignore the recorded state and download everything again.")
+    args = parser.parse_args()
+    asset_dir, archs = args.asset_dir, [a.strip() for a in args.arch.split(",") if a.strip()]
+    unknown = [a for a in archs if a not in TARGET_ARCHITECTURES]
+    if unknown: parser.error(f"Unknown arch(s): {', '.join(unknown)} (choose from {', '.join(TARGET_ARCHITECTURES)})")
     print("WIPT Setup Script - Fetching Magisk Assets (Refined)")
-    os.makedirs(ASSET_DIR, exist_ok=True)
-    print(f"Asset directory: {os.path.abspath(ASSET_DIR)}")
+    os.makedirs(asset_dir, exist_ok=True)
+    print(f"Asset directory: {os.path.abspath(asset_dir)}")
+    manager = AssetManager(asset_dir, args.jobs, force=args.force)
 
-    # 1. Download Magisk APK
-    magisk_apk_url, magisk_apk_path = None, os.path.join(ASSET_DIR, "Magisk.apk")
-    print(f"Getting Magisk release info from {MAGISK_API_URL}...")
-    try:
-        response = requests.get(MAGISK_API_URL, timeout=10)
-        response.raise_for_status()
-        assets = response.json().get("assets", [])
-        magisk_apk_url = next((a.get("browser_download_url") for a in assets if a.get("name","").lower().endswith(".apk")), None)
-        if magisk_apk_url: print(f"Found Magisk APK URL: {magisk_apk_url}")
-        else: print("Error: Could not find Magisk APK URL in release.")
-    except Exception as e: print(f"Error fetching/processing Magisk release info: {e}")
-
-    if magisk_apk_url:
-        if not download_file(magisk_apk_url, magisk_apk_path): magisk_apk_path = None
-    else: magisk_apk_path = None
-
-    # 2. Extract assets
+    # 1. Download Magisk APK (and magiskboot.exe on Windows) concurrently
+    magisk_apk_path, magiskboot_final_path = os.path.join(asset_dir, "Magisk.apk"), os.path.join(asset_dir, "magiskboot.exe" if os.name == 'nt' else "magiskboot")
+    print(f"Getting Magisk release info from {args.api_url}...")
+    release, downloads = manager.fetch_release(args.api_url, args.offline), []
+    apk_asset = next((a for a in (release or {}).get("assets", []) if (a.get("name") or "").lower().endswith(".apk")), None)
+    if apk_asset:
+        print(f"Found Magisk APK URL: {apk_asset['browser_download_url']} (tag {release.get('tag_name')})")
+        downloads.append({"name": os.path.basename(magisk_apk_path), "url": apk_asset["browser_download_url"], "size": apk_asset.get("size"),
+                          "sha256": release_asset_sha256(apk_asset), "tag": release.get("tag_name")})
+    elif release is not None: print("Error: Could not find Magisk APK URL in release.")
+    if os.name == 'nt': print("Downloading magiskboot.exe for Windows..."); downloads.append({"name": os.path.basename(magiskboot_final_path), "url": args.magiskboot_url})
+    if args.offline:
+        for item in downloads: print(f"Offline: {'using the existing' if os.path.exists(os.path.join(asset_dir, item['name'])) else 'not downloading missing'} {item['name']}")
+        downloads = []
+    results = manager.fetch_all(downloads)
+    if not results.get(os.path.basename(magisk_apk_path)) and not (args.offline and os.path.exists(magisk_apk_path)): magisk_apk_path = None
+    if os.name == 'nt' and not os.path.exists(magiskboot_final_path): print(f"Failed to download magiskboot.exe. Place it manually in '{asset_dir}'.")
+    print(manager.summary())
+
+    # 2. Extract assets (skipped when the manifest shows this exact APK was already extracted for these archs)
     if magisk_apk_path and os.path.exists(magisk_apk_path):
-        if not extract_assets_from_apk_refined(magisk_apk_path, ASSET_DIR):
+        if manifest_is_current(load_asset_manifest(asset_dir), sha256_file(magisk_apk_path), archs, asset_dir):
+            print(f"Assets for {', '.join(archs)} already extracted from this APK, skipping extraction.")
+        elif not extract_assets_from_apk_refined(magisk_apk_path, asset_dir, archs, (release or {}).get("tag_name"), args.jobs):
             print("Failed to extract some/all assets from Magisk APK.")
     else: print("Magisk APK not downloaded or not found, skipping extraction.")
 
-    # 3. Handle magiskboot
-    magiskboot_final_path = os.path.join(ASSET_DIR, "magiskboot.exe" if os.name == 'nt' else "magiskboot")
-    if os.name == 'nt':
-        print("Downloading magiskboot.exe for Windows...")
-        if not download_file(MAGISKBOOT_WINDOWS_URL, magiskboot_final_path):
-            print(f"Failed to download magiskboot.exe. Place it manually in '{ASSET_DIR}'.")
-    else: # Linux/macOS: Try to use an extracted magiskinit (e.g., magiskinit_arm64) as magiskboot
+    # 3. Handle magiskboot (downloaded with the APK on Windows)
+    if os.name != 'nt': # Linux/macOS: Try to use an extracted magiskinit (e.g., magiskinit_arm64) as magiskboot
         # Find the most suitable magiskinit (prefer arm64, then arm, then others)
         preferred_magiskinit_name = None
         for arch_short_name in ["arm64", "arm", "x64", "x86"]: # Order of preference
             potential_name = f"magiskinit_{arch_short_name}"
-            if os.path.exists(os.path.join(ASSET_DIR, potential_name)):
+            if os.path.exists(os.path.join(asset_dir, potential_name)):
                 preferred_magiskinit_name = potential_name
                 break
 
         if preferred_magiskinit_name:
-            source_magiskinit_path = os.path.join(ASSET_DIR, preferred_magiskinit_name)
+            source_magiskinit_path = os.path.join(asset_dir, preferred_magiskinit_name)
             print(f"Attempting to use '{preferred_magiskinit_name}' as 'magiskboot' for non-Windows OS...")
             try:
                 shutil.copy2(source_magiskinit_path, magiskboot_final_path)
@@ -157,19 +336,19 @@ def main():
                 print(f"Successfully copied '{preferred_magiskinit_name}' to '{magiskboot_final_path}' and made executable.")
             except Exception as e: print(f"Error setting up magiskboot from {preferred_magiskinit_name}: {e}")
         else:
-            print(f"No suitable magiskinit found in {ASSET_DIR} to use as magiskboot. Please provide 'magiskboot' manually.")
+            print(f"No suitable magiskinit found in {asset_dir} to use as magiskboot. Please provide 'magiskboot' manually.")
 
     # --- Summary ---
     print("\n--- WIPT Setup Summary (Refined) ---")
-    print(f"Magisk assets expected in: {os.path.abspath(ASSET_DIR)}")
+    print(f"Magisk assets expected in: {os.path.abspath(asset_dir)}")
 
     # List expected arch-specific files based on successful extraction patterns
     expected_files = [magiskboot_final_path]
-    for short_arch in TARGET_ARCHITECTURES.keys():
+    for short_arch in archs:
         for name_pattern in ARCH_SPECIFIC_ASSETS_FROM_APK.values():
-            expected_files.append(os.path.join(ASSET_DIR, f"{name_pattern}_{short_arch}"))
+            expected_files.append(os.path.join(asset_dir, f"{name_pattern}_{short_arch}"))
     for common_target in COMMON_ASSETS_FROM_APK.values():
-        expected_files.append(os.path.join(ASSET_DIR, common_target))
+        expected_files.append(os.path.join(asset_dir, common_target))
 
     # Remove duplicates and sort for cleaner print
     expected_files = sorted(list(set(expected_files)))
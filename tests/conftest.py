@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The repo is a flat set of scripts, not a package: make wipt, setup and bench_wipt importable from the tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
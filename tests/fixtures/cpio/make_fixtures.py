@@ -0,0 +1,61 @@
+"""Regenerates tests/fixtures/cpio: input.cpio, the files the commands add, and expected/<case>.cpio, the output of
+`magiskboot cpio` for each command list in cases.json. Needs a real magiskboot:
+
+    python tests/fixtures/cpio/make_fixtures.py --magiskboot /path/to/magiskboot
+
+The binary's SHA-256 is recorded in cases.json as "generated_by"."""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def newc_entry(name, mode, data=b"", ino=1, uid=0, gid=0, nlink=1, mtime=0):
+    """One newc entry as other tools write them (arbitrary inodes, nlink and mtime)."""
+    name_b = name.encode() + b"\0"
+    fields = (ino, mode, uid, gid, nlink, mtime, len(data), 0, 0, 0, 0, len(name_b), 0)
+    head = b"070701" + b"".join(b"%08x" % v for v in fields) + name_b
+    head += b"\0" * (-len(head) % 4)
+    return head + data + b"\0" * (-len(data) % 4)
+
+def input_ramdisk():
+    """Unsorted, with '.', nlink 2, non-zero mtimes and a non-root gid, as a stock ramdisk packed by another tool."""
+    return b"".join([
+        newc_entry(".", 0o40755, ino=7, nlink=2, mtime=1700000000),
+        newc_entry("sbin", 0o40750, ino=9, gid=2000, nlink=2, mtime=1700000000),
+        newc_entry("sbin/adbd", 0o100750, b"\x7fELF adbd" * 40, ino=10, mtime=1700000000),
+        newc_entry("init", 0o100750, b"#!init\n" * 30, ino=8, mtime=1700000000),
+        newc_entry("fstab.test", 0o100640, b"/dev/block/by-name/system /system ext4 ro wait\n", ino=11, mtime=1700000000),
+        newc_entry("TRAILER!!!", 0, ino=0, nlink=1),
+    ])
+
+FILES = {"magiskinit": b"\x7fELF magiskinit" * 50, "magisk.xz": b"\xfd7zXZ\x00 not really xz" * 20,
+         "config": b"KEEPVERITY=false\nKEEPFORCEENCRYPT=false\nRECOVERYMODE=false\n"}
+
+def write_inputs():
+    with open(os.path.join(FIXTURE_DIR, "input.cpio"), 'wb') as f: f.write(input_ramdisk())
+    for name, data in FILES.items():
+        with open(os.path.join(FIXTURE_DIR, "files", name), 'wb') as f: f.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--magiskboot", required=True)
+    args = parser.parse_args()
+    with open(os.path.join(FIXTURE_DIR, "cases.json"), encoding='utf-8') as f: cases = json.load(f)
+    write_inputs()
+    with open(args.magiskboot, 'rb') as f: binary_sha256 = hashlib.sha256(f.read()).hexdigest()
+    for case, commands in cases["cases"].items():
+        with tempfile.TemporaryDirectory() as tmp:
+            work = os.path.join(tmp, "ramdisk.cpio"); shutil.copy(os.path.join(FIXTURE_DIR, "input.cpio"), work)
+            subprocess.run([os.path.abspath(args.magiskboot), "cpio", work] + commands, cwd=FIXTURE_DIR, check=True)
+            shutil.copy(work, os.path.join(FIXTURE_DIR, "expected", f"{case}.cpio"))
+        print(f"{case}: {len(commands)} command(s)")
+    cases["generated_by"] = f"magiskboot sha256:{binary_sha256}"
+    with open(os.path.join(FIXTURE_DIR, "cases.json"), 'w', encoding='utf-8') as f: json.dump(cases, f, indent=2); f.write("\n")
+
+if __name__ == "__main__": sys.exit(main())
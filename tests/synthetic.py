@@ -0,0 +1,170 @@
+"""Small synthetic inputs for the tests, built in memory so no firmware binaries are checked in."""
+import hashlib
+import io
+import os
+import struct
+import tarfile
+import zipfile
+
+import bench_wipt
+import wipt
+
+def ramdisk_entries():
+    return {"init": [0o100750, 0, 0, 0, 0, b"#!init\n" * 64], "system": [0o40755, 0, 0, 0, 0, b""],
+            "system/bin": [0o40755, 0, 0, 0, 0, b""], "system/bin/sh": [0o100755, 0, 2000, 0, 0, bytes(range(256)) * 16]}
+
+def ramdisk(fmt="gzip"): return wipt.compress_ramdisk(fmt, wipt.RamdiskCpio(ramdisk_entries()).to_bytes())
+
+def boot_image(header_version, ramdisk_fmt="gzip"):
+    """A small boot image with every section its header version has, each filled with a distinct pattern."""
+    extras = {"second": b"2nd" * 300 if header_version <= 2 else b"", "recovery_dtbo": b"dtbo" * 500 if header_version in (1, 2) else b"",
+              "dtb": b"dtb!" * 700 if header_version == 2 else b"", "signature": b"\x5a" * 4096 if header_version == 4 else b""}
+    return bench_wipt.build_boot_image(header_version, b"kernel" * 1000, ramdisk(ramdisk_fmt), **extras)
+
+def magisk_workspace(root):
+    """root/vendor/magisk-assets with synthetic Magisk assets, as _magisk_patcher expects under the current directory."""
+    return bench_wipt.prepare_workspace(str(root))
+
+def write(path, data):
+    os.makedirs(os.path.dirname(str(path)) or ".", exist_ok=True)
+    with open(path, 'wb') as f: f.write(data)
+    return str(path)
+
+def vendor_boot_image(header_version, page_size=4096, ramdisk_fmt="lz4"):
+    """A vendor_boot v3/v4 image as mkbootimg lays it out; v4 gets a one-entry vendor ramdisk table and a bootconfig."""
+    vendor_ramdisk, dtb = ramdisk(ramdisk_fmt), b"\xd0\x0d\xfe\xed" + b"vendor dtb" * 200
+    header_size = 2128 if header_version == 4 else 2112
+    header = bytearray(page_size)
+    struct.pack_into('<8s6I', header, 0, wipt.VENDOR_BOOT_MAGIC, header_version, page_size, 0x8000, 0x1000000, len(vendor_ramdisk), 0)
+    header[28:28 + 19] = b"console=ttyMSM0 v=1"
+    struct.pack_into('<I16sIIQ', header, 2076, 0x100, b"vendor", header_size, len(dtb), 0x1F00000)
+    sections = [vendor_ramdisk, dtb]
+    if header_version == 4:
+        table = struct.pack('<III32s64s', len(vendor_ramdisk), 0, 1, b"", b"") # VENDOR_RAMDISK_TYPE_PLATFORM
+        bootconfig = b"androidboot.hardware=test\n"
+        struct.pack_into('<IIII', header, 2112, len(table), 1, len(table), len(bootconfig))
+        sections += [table, bootconfig]
+    return bytes(header) + b"".join(bench_wipt._pad(data, page_size) for data in sections)
+
+def sparse_image(chunks, block_size=4096):
+    """An Android sparse image from ("raw", data), ("fill", pattern, blocks), ("dont_care", blocks) and ("crc32", value)
+    chunks. Returns (sparse bytes, the raw image it decodes to)."""
+    body, raw, total_blocks = [], [], 0
+    for kind, *args in chunks:
+        if kind == "raw":
+            data, = args; blocks = len(data) // block_size
+            body.append(struct.pack('<HHII', wipt.SPARSE_CHUNK_RAW, 0, blocks, 12 + len(data)) + data); raw.append(data)
+        elif kind == "fill":
+            pattern, blocks = args
+            body.append(struct.pack('<HHII', wipt.SPARSE_CHUNK_FILL, 0, blocks, 16) + pattern); raw.append(pattern * (blocks * block_size // 4))
+        elif kind == "dont_care":
+            blocks, = args
+            body.append(struct.pack('<HHII', wipt.SPARSE_CHUNK_DONT_CARE, 0, blocks, 12)); raw.append(bytes(blocks * block_size))
+        else: body.append(struct.pack('<HHII', wipt.SPARSE_CHUNK_CRC32, 0, 0, 16) + struct.pack('<I', args[0])); blocks = 0
+        total_blocks += blocks
+    header = struct.pack('<IHHHHIIII', wipt.SPARSE_HEADER_MAGIC, 1, 0, 28, 12, block_size, total_blocks, len(chunks), 0)
+    return header + b"".join(body), b"".join(raw)
+
+def sparse_from_raw(raw, block_size=4096):
+    """Wraps a raw image as img2simg would: runs of all-zero blocks become DONT_CARE, everything else RAW."""
+    chunks, zero = [], bytes(block_size)
+    for start in range(0, len(raw), block_size):
+        block, kind = raw[start:start + block_size], "dont_care" if raw[start:start + block_size] == zero else "raw"
+        if chunks and chunks[-1][0] == kind: chunks[-1] = (kind, chunks[-1][1] + (block if kind == "raw" else 1))
+        else: chunks.append((kind, block if kind == "raw" else 1))
+    return sparse_image(chunks, block_size)[0]
+
+def allocated_bytes(path):
+    """Bytes the filesystem actually allocated for path: less than its size when it has holes."""
+    return os.stat(path).st_blocks * 512
+
+def super_image(partitions, slot_count=2, metadata_max_size=4096, first_sector=64):
+    """A single-device liblp super image (metadata v10.0). `partitions` maps name -> list of ("linear", data) and
+    ("zero", length) extents; linear extents are laid out round-robin across partitions, so multi-extent partitions
+    are interleaved on disk. Returns (image bytes, name -> partition contents)."""
+    sector, data, extents, entries, contents = wipt.LP_SECTOR_SIZE, bytearray(first_sector * wipt.LP_SECTOR_SIZE), [], [], {}
+    placed = {name: [] for name in partitions}
+    for index in range(max((len(e) for e in partitions.values()), default=0)):
+        for name, partition_extents in partitions.items():
+            if index >= len(partition_extents): continue
+            kind, payload = partition_extents[index]
+            if kind == "linear": placed[name].append((len(payload) // sector, wipt.LP_TARGET_TYPE_LINEAR, len(data) // sector)); data += payload
+            else: placed[name].append((payload // sector, wipt.LP_TARGET_TYPE_ZERO, 0))
+    for name, partition_extents in partitions.items():
+        entries.append(struct.pack('<36sIIII', name.encode(), wipt.LP_PARTITION_ATTR_READONLY, len(extents), len(placed[name]), 1))
+        extents += [struct.pack('<QIQI', num_sectors, target_type, target_data, 0) for num_sectors, target_type, target_data in placed[name]]
+        contents[name] = b"".join(payload if kind == "linear" else bytes(payload) for kind, payload in partition_extents)
+    groups = [struct.pack('<36sIQ', b"default", 0, 0), struct.pack('<36sIQ', b"main", 0, len(data))]
+    devices = [struct.pack('<QIIQ36sI', first_sector, 0, 0, len(data), b"super", 0)]
+    tables, descriptors = b"", b""
+    for table, entry_size in ((entries, 52), (extents, 24), (groups, 48), (devices, 64)):
+        descriptors += struct.pack('<III', len(tables), len(table), entry_size); tables += b"".join(table)
+    header = bytearray(struct.pack('<IHHI32sI32s', wipt.LP_METADATA_HEADER_MAGIC, 10, 0, 128, bytes(32), len(tables), hashlib.sha256(tables).digest()) + descriptors)
+    header[12:44] = hashlib.sha256(header).digest()
+    geometry = bytearray(struct.pack('<II32sIII', wipt.LP_METADATA_GEOMETRY_MAGIC, 52, bytes(32), metadata_max_size, slot_count, 4096))
+    geometry[8:40] = hashlib.sha256(geometry).digest()
+    metadata = bench_wipt._pad(bytes(header) + tables, metadata_max_size) * slot_count
+    head = bytes(wipt.LP_PARTITION_RESERVED_BYTES) + bench_wipt._pad(bytes(geometry), wipt.LP_METADATA_GEOMETRY_SIZE) * 2 + metadata * 2 # Primary, backup
+    if len(head) > first_sector * sector: raise ValueError("Metadata overlaps the first partition sector; raise first_sector")
+    data[:len(head)] = head
+    return bytes(data), contents
+
+def transfer_list(version, commands):
+    """Transfer list text for `commands` ((op, [(start, end), ...]) pairs); v2+ get the stash count lines."""
+    total = sum(end - start for op, ranges in commands if op == "new" for start, end in ranges)
+    lines = [str(version), str(total)] + (["0", "0"] if version >= 2 else [])
+    for op, ranges in commands: lines.append(f"{op} {len(ranges) * 2}," + ",".join(f"{start},{end}" for start, end in ranges))
+    return "\n".join(lines) + "\n"
+
+def _pb_varint(value):
+    out = bytearray()
+    while True:
+        out.append(value & 0x7F | (0x80 if value > 0x7F else 0)); value >>= 7
+        if not value: return bytes(out)
+
+def _pb(field, value):
+    """One protobuf field: ints as varints, bytes as length-delimited."""
+    if isinstance(value, int): return _pb_varint(field << 3) + _pb_varint(value)
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(value)) + value
+
+PAYLOAD_ENCODERS = {wipt.PAYLOAD_OP_REPLACE: lambda data: data, wipt.PAYLOAD_OP_REPLACE_BZ: wipt.bz2.compress,
+                    wipt.PAYLOAD_OP_REPLACE_XZ: wipt.lzma.compress}
+
+def payload(partitions, block_size=4096, with_sizes=True):
+    """A full-OTA payload.bin (v2). `partitions` maps name -> list of (op_type, data, dst_extents) with dst_extents
+    [(start_block, num_blocks), ...]; data is None for ZERO/DISCARD. Unknown manifest fields (minor version, a
+    fixed32) are mixed in, as real manifests carry many. Returns (payload bytes, name -> partition contents)."""
+    manifest, blobs, contents = _pb(3, block_size) + _pb(12, 0) + bytes([0x7D]) + b"\1\2\3\4", bytearray(), {} # field 15, wire type 5
+    for name, ops in partitions.items():
+        size = max((start + count for _, _, extents in ops for start, count in extents), default=0) * block_size
+        image, encoded_ops = bytearray(size), b""
+        for op_type, data, extents in ops:
+            op = _pb(1, op_type) + b"".join(_pb(6, _pb(1, start) + _pb(2, count)) for start, count in extents)
+            if data is not None:
+                blob = PAYLOAD_ENCODERS[op_type](data)
+                op += _pb(2, len(blobs)) + _pb(3, len(blob)); blobs += blob
+                pos = 0
+                for start, count in extents: image[start * block_size:(start + count) * block_size] = data[pos:pos + count * block_size]; pos += count * block_size
+            encoded_ops += _pb(8, op)
+        manifest += _pb(13, _pb(1, name.encode()) + (_pb(7, _pb(1, size)) if with_sizes else b"") + encoded_ops)
+        contents[name] = bytes(image)
+    signature = b"metadata signature"
+    return wipt.PAYLOAD_MAGIC + struct.pack('>QQI', 2, len(manifest), len(signature)) + manifest + signature + bytes(blobs), contents
+
+def tar_archive(members, md5_name=None):
+    """An uncompressed ustar archive of name -> data, in order. With md5_name, a Samsung MD5 trailer line
+    ("<md5 of the tar>  <md5_name>\\n") is appended, as in a .tar.md5."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name); info.size, info.mode = len(data), 0o644
+            tar.addfile(info, io.BytesIO(data))
+    data = buf.getvalue()
+    return data + f"{hashlib.md5(data).hexdigest()}  {md5_name}\n".encode() if md5_name else data
+
+def ota_zip(members):
+    """A zip of name -> (data, compress_type), in order, as OTA packages are laid out."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, (data, compress_type) in members.items(): zf.writestr(name, data, compress_type=compress_type)
+    return buf.getvalue()
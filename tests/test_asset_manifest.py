@@ -0,0 +1,41 @@
+"""The shared asset manifest module and how MagiskPatcher uses the manifest: for listing, not for presence."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import synthetic
+import wipt
+import wipt_assets
+
+REPO = os.path.dirname(os.path.abspath(wipt.__file__))
+
+def _write_manifest(assets_dir, names):
+    manifest = {"version": "v99.0", "archs": ["arm64"], "assets": {name: {"arch": "arm64", "sha256": "0" * 64, "size": 1} for name in names}}
+    with open(os.path.join(assets_dir, wipt_assets.ASSET_MANIFEST_NAME), 'w', encoding='utf-8') as f: json.dump(manifest, f)
+    return manifest
+
+def test_setup_does_not_import_wipt():
+    code = "import sys, setup; print('wipt' in sys.modules, 'lz4' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO, check=True, capture_output=True, text=True)
+    assert result.stdout.split() == ["False", "False"]
+
+def test_load_asset_manifest(tmp_path):
+    assert wipt_assets.load_asset_manifest(str(tmp_path)) is None
+    manifest = _write_manifest(str(tmp_path), ["magisk_arm64"])
+    assert wipt_assets.load_asset_manifest(str(tmp_path)) == manifest and wipt.load_asset_manifest is wipt_assets.load_asset_manifest
+    for bad in ("not json", "[]", '{"assets": []}'):
+        (tmp_path / wipt_assets.ASSET_MANIFEST_NAME).write_text(bad)
+        assert wipt_assets.load_asset_manifest(str(tmp_path)) is None
+
+def test_listed_but_deleted_asset_is_missing(tmp_path):
+    assets = synthetic.magisk_workspace(tmp_path)
+    _write_manifest(assets, ["magisk_arm64", "magiskinit_arm64", "initld_arm64", "stub.apk"])
+    os.remove(os.path.join(assets, "stub.apk"))
+    patcher = wipt.MagiskPatcher(os.path.join(assets, "magiskboot"), assets, str(tmp_path / "work"), {"XZ_CACHE": False, "UNPACK_CACHE": False})
+    assert patcher.stub_apk_path is None and patcher.initld_asset_path == os.path.join(assets, "initld_arm64")
+    os.remove(os.path.join(assets, "magiskinit_arm64"))
+    with pytest.raises(FileNotFoundError, match="magiskinit_arm64.*rerun it with --arch arm64"):
+        wipt.MagiskPatcher(os.path.join(assets, "magiskboot"), assets, str(tmp_path / "work"), {"XZ_CACHE": False, "UNPACK_CACHE": False})
@@ -0,0 +1,73 @@
+"""TransferList plans and rebuild_block_image over synthetic .transfer.list / .new.dat(.br) pairs."""
+import os
+
+import pytest
+
+import synthetic
+import wipt
+
+BLOCK = wipt.DAT_BLOCK_SIZE
+# erase everything, write two ranges (out of order on disk), then zero one block of written data and one never written
+COMMANDS = [("erase", [(0, 40)]), ("new", [(10, 14), (2, 4)]), ("zero", [(12, 13), (30, 32)]), ("new", [(20, 22)])]
+
+def new_data():
+    return b"".join(bytes([index]) * BLOCK for index in range(1, 9)) # 8 blocks: 10-13, 2-3, 20-21
+
+def expected_image():
+    image, data = bytearray(40 * BLOCK), new_data()
+    for (start, end), pos in (((10, 14), 0), ((2, 4), 4), ((20, 22), 6)): image[start * BLOCK:end * BLOCK] = data[pos * BLOCK:(pos + end - start) * BLOCK]
+    image[12 * BLOCK:13 * BLOCK] = bytes(BLOCK)
+    return bytes(image)
+
+def _write_pair(tmp_path, version, dat=None, suffix=".new.dat", commands=COMMANDS):
+    list_path = tmp_path / "system.transfer.list"; list_path.write_text(synthetic.transfer_list(version, commands))
+    return str(list_path), synthetic.write(tmp_path / f"system{suffix}", new_data() if dat is None else dat)
+
+@pytest.mark.parametrize("version", [1, 2, 3, 4])
+def test_versions_rebuild_the_same_image(version, tmp_path):
+    list_path, dat_path = _write_pair(tmp_path, version)
+    transfer_list = wipt.TransferList(list_path)
+    assert (transfer_list.version, transfer_list.size, transfer_list.new_blocks) == (version, 40 * BLOCK, 8)
+    assert transfer_list.counts == {"erase": 1, "new": 2, "zero": 1}
+    stats = wipt.rebuild_block_image(transfer_list, dat_path, str(tmp_path / "system.img"))
+    assert (tmp_path / "system.img").read_bytes() == expected_image()
+    assert stats == {"new_bytes": 8 * BLOCK, "zero_bytes_written": BLOCK, "hole_bytes": 32 * BLOCK}
+
+def test_zero_over_new_is_written_and_erase_stays_a_hole(tmp_path):
+    transfer_list = wipt.TransferList(_write_pair(tmp_path, 4)[0])
+    assert transfer_list.plan == [("new", 10, 14), ("new", 2, 4), ("zero", 12, 13), ("new", 20, 22)]
+    assert transfer_list.zero_write_blocks == 1 and transfer_list.hole_blocks == 40 - 8
+    wipt.rebuild_block_image(transfer_list, str(tmp_path / "system.new.dat"), str(tmp_path / "system.img"))
+    assert synthetic.allocated_bytes(tmp_path / "system.img") <= 10 * BLOCK
+
+def test_brotli_stream_is_decoded_in_bounded_chunks(tmp_path, monkeypatch):
+    brotli = pytest.importorskip("brotli")
+    monkeypatch.setattr(wipt, "DAT_IO_CHUNK", 64 * 1024)
+    zeros = synthetic.write(tmp_path / "zeros.new.dat.br", brotli.compress(bytes(8 << 20)))
+    chunks = [len(chunk) for chunk in wipt._dat_stream_chunks(zeros)]
+    assert sum(chunks) == 8 << 20 and max(chunks) <= 4 * wipt.DAT_IO_CHUNK # The output limit is soft, but bounded
+    monkeypatch.setattr(wipt, "DAT_IO_CHUNK", 3000) # Decoded chunks not block aligned, so writes straddle them
+    list_path, dat_path = _write_pair(tmp_path, 3, brotli.compress(new_data()), ".new.dat.br")
+    wipt.rebuild_block_image(wipt.TransferList(list_path), dat_path, str(tmp_path / "system.img"))
+    assert (tmp_path / "system.img").read_bytes() == expected_image()
+
+def test_extract_command_finds_the_transfer_list(tmp_path, capsys):
+    brotli = pytest.importorskip("brotli")
+    _, dat_path = _write_pair(tmp_path, 4, brotli.compress(new_data()), ".new.dat.br")
+    wipt.handle_extract(wipt.argparse.Namespace(input=dat_path, output=str(tmp_path / "out"), list=False, partitions=None, slot=0, workers=0, transfer_list=None))
+    assert "version 4" in capsys.readouterr().out
+    assert (tmp_path / "out" / "system.img").read_bytes() == expected_image()
+
+def test_rejects_incremental_and_short_data(tmp_path):
+    list_path, _ = _write_pair(tmp_path, 4, commands=COMMANDS + [("move", [(0, 1)])])
+    with pytest.raises(ValueError, match="incremental"): wipt.TransferList(list_path)
+    list_path, dat_path = _write_pair(tmp_path, 4, new_data()[:-BLOCK])
+    with pytest.raises(EOFError): wipt.rebuild_block_image(wipt.TransferList(list_path), dat_path, str(tmp_path / "system.img"))
+    (tmp_path / "bad.transfer.list").write_text("5\n0\n0\n0\n")
+    with pytest.raises(ValueError, match="version"): wipt.TransferList(str(tmp_path / "bad.transfer.list"))
+
+def test_truncated_brotli_stream_raises(tmp_path):
+    brotli = pytest.importorskip("brotli")
+    compressed = brotli.compress(os.urandom(8 * BLOCK))
+    list_path, dat_path = _write_pair(tmp_path, 4, compressed[:len(compressed) // 2], ".new.dat.br")
+    with pytest.raises(EOFError): wipt.rebuild_block_image(wipt.TransferList(list_path), dat_path, str(tmp_path / "system.img"))
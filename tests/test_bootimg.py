@@ -0,0 +1,81 @@
+import hashlib
+import struct
+import types
+
+import pytest
+
+import synthetic
+import wipt
+
+IMAGES = [("boot", v) for v in range(5)] + [("vendor_boot", 3), ("vendor_boot", 4)]
+TAIL = b"SEANDROIDENFORCE"
+
+def build(kind, version):
+    return (synthetic.boot_image(version) if kind == "boot" else synthetic.vendor_boot_image(version)) + TAIL
+
+def sections_of(path):
+    with wipt.BootImage(str(path)) as img: return {name: bytes(view) for name, view in img.sections.items()}, bytes(img.header)
+
+def mkbootimg_id(sections, version):
+    """The id mkbootimg stores at offset 576 for v0-v2: SHA-1 over each section followed by its size."""
+    digest = hashlib.sha1()
+    for name in ["kernel", "ramdisk", "second"] + (["recovery_dtbo"] if version >= 1 else []) + (["dtb"] if version >= 2 else []):
+        digest.update(sections[name]); digest.update(struct.pack('<I', len(sections[name])))
+    return digest.digest().ljust(32, b"\0")
+
+@pytest.mark.parametrize("kind,version", IMAGES)
+def test_unmodified_write_is_byte_identical(kind, version, tmp_path):
+    source = synthetic.write(tmp_path / "in.img", build(kind, version))
+    with wipt.BootImage(source) as img:
+        assert (img.kind, img.header_version) == (kind, version)
+        img.write(str(tmp_path / "out.img"))
+    assert (tmp_path / "out.img").read_bytes() == (tmp_path / "in.img").read_bytes()
+
+@pytest.mark.parametrize("kind,version", IMAGES)
+def test_replaced_ramdisk_keeps_other_sections(kind, version, tmp_path):
+    source = synthetic.write(tmp_path / "in.img", build(kind, version))
+    before, header_before = sections_of(source)
+    new_ramdisk = wipt.compress_ramdisk("gzip", wipt.RamdiskCpio({"init": [0o100750, 0, 0, 0, 0, b"patched" * 3001]}).to_bytes())
+    with wipt.BootImage(source) as img:
+        page_size = img.page_size
+        img.write(str(tmp_path / "out.img"), {"ramdisk": new_ramdisk})
+    after, header_after = sections_of(tmp_path / "out.img")
+    assert after["ramdisk"] == new_ramdisk
+    unchanged = {name for name in before if name not in ("ramdisk", "vendor_ramdisk_table")}
+    assert {name: after[name] for name in unchanged} == {name: before[name] for name in unchanged}
+    data = (tmp_path / "out.img").read_bytes()
+    assert data.endswith(TAIL) and (len(data) - len(TAIL)) % page_size == 0
+    if kind == "boot" and version <= 2:
+        assert header_after[wipt.BOOT_ID_OFFSET:wipt.BOOT_ID_OFFSET + 32] == mkbootimg_id(after, version)
+        assert header_after[wipt.BOOT_ID_OFFSET:wipt.BOOT_ID_OFFSET + 32] != header_before[wipt.BOOT_ID_OFFSET:wipt.BOOT_ID_OFFSET + 32]
+    if kind == "vendor_boot" and version == 4:
+        assert struct.unpack_from('<I', after["vendor_ramdisk_table"])[0] == len(new_ramdisk)
+        assert after["vendor_ramdisk_table"][4:] == before["vendor_ramdisk_table"][4:]
+
+@pytest.mark.parametrize("version", [0, 1, 2])
+def test_source_id_matches_mkbootimg(version, tmp_path):
+    sections, header = sections_of(synthetic.write(tmp_path / "in.img", build("boot", version)))
+    assert header[wipt.BOOT_ID_OFFSET:wipt.BOOT_ID_OFFSET + 32] == mkbootimg_id(sections, version)
+
+def _patcher(tmp_path):
+    return types.SimpleNamespace(options={}, logger=lambda message: None, unpack_cache=None, working_dir=str(tmp_path),
+                                 _unpack_cache_key=lambda *args: None)
+
+@pytest.mark.parametrize("fmt", ["gzip", "xz", "lz4", "lz4_legacy"])
+def test_truncated_ramdisk_falls_back_to_magiskboot(fmt, tmp_path):
+    ramdisk = synthetic.ramdisk(fmt)
+    source = synthetic.write(tmp_path / "in.img", bench_boot(ramdisk[:len(ramdisk) // 2]))
+    assert wipt.MagiskPatcher._patch_in_process(_patcher(tmp_path), source, [], str(tmp_path / "new-boot.img")) is False
+    assert not (tmp_path / "new-boot.img").exists()
+
+def test_write_errors_are_not_swallowed(tmp_path, monkeypatch):
+    source = synthetic.write(tmp_path / "in.img", build("boot", 2))
+    def no_space(self, dest_path, replacements=None): raise OSError(28, "No space left on device")
+    monkeypatch.setattr(wipt.BootImage, "write", no_space)
+    with pytest.raises(OSError): wipt.MagiskPatcher._patch_in_process(_patcher(tmp_path), source, [], str(tmp_path / "new-boot.img"))
+
+def test_bad_cpio_commands_are_not_swallowed(tmp_path):
+    source = synthetic.write(tmp_path / "in.img", build("boot", 2))
+    with pytest.raises(ValueError): wipt.MagiskPatcher._patch_in_process(_patcher(tmp_path), source, ["rmdir nothing"], str(tmp_path / "new-boot.img"))
+
+def bench_boot(ramdisk): return synthetic.bench_wipt.build_boot_image(2, b"kernel" * 1000, ramdisk)
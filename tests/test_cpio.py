@@ -0,0 +1,156 @@
+"""RamdiskCpio must write ramdisks exactly as `magiskboot cpio` does: entries sorted by name, inodes numbered from
+300000, nlink 1, mtime 0 and a TRAILER!!! entry with mode 0755. fixtures/cpio holds expected outputs for the
+add/mkdir/mv/rm/backup command lists in its cases.json (see make_fixtures.py there for regenerating them with a
+magiskboot binary); when one is runnable (WIPT_TEST_MAGISKBOOT, or the one in vendor/magisk-assets) the same
+commands are also run through it live."""
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import wipt
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "cpio")
+with open(os.path.join(FIXTURE_DIR, "cases.json"), encoding='utf-8') as f: FIXTURE_CASES = json.load(f)["cases"]
+
+def newc_entry(name, mode, data=b"", ino=1, uid=0, gid=0, nlink=1, mtime=0):
+    """One newc entry as other tools write them (arbitrary inodes, nlink and mtime), used as synthetic input."""
+    name_b = name.encode() + b"\0"
+    fields = (ino, mode, uid, gid, nlink, mtime, len(data), 0, 0, 0, 0, len(name_b), 0)
+    head = b"070701" + b"".join(b"%08x" % v for v in fields) + name_b
+    head += b"\0" * (-len(head) % 4)
+    return head + data + b"\0" * (-len(data) % 4)
+
+def synthetic_ramdisk():
+    """Unsorted input with a '.' entry, a non-root gid, nlink 2 and non-zero mtimes, closed by a plain trailer."""
+    return b"".join([
+        newc_entry(".", 0o40755, ino=7, nlink=2, mtime=1700000000),
+        newc_entry("sbin", 0o40755, ino=9, gid=2000, nlink=2, mtime=1700000000),
+        newc_entry("init", 0o100750, b"#!init\n", ino=8, mtime=1700000000),
+        newc_entry("TRAILER!!!", 0, ino=0, nlink=1),
+    ])
+
+COMMANDS = ["mkdir 0750 overlay.d", "add 0644 overlay.d/init.rc {rc}", "add 0750 init {init}"]
+INIT_RC, MAGISKINIT = b"on boot\n", b"magiskinit"
+
+# magiskboot's dump of synthetic_ramdisk() after COMMANDS. Header fields: magic, ino, mode, uid, gid, nlink, mtime,
+# filesize, devmajor, devminor, rdevmajor, rdevminor, namesize, check; names and data padded to 4 bytes.
+GOLDEN = b"".join([
+    b"070701", b"000493e0", b"000081e8", b"00000000", b"00000000", b"00000001", b"00000000", b"0000000a",
+    b"00000000", b"00000000", b"00000000", b"00000000", b"00000005", b"00000000", b"init\0", b"\0",
+    b"magiskinit", b"\0\0",
+    b"070701", b"000493e1", b"000041e8", b"00000000", b"00000000", b"00000001", b"00000000", b"00000000",
+    b"00000000", b"00000000", b"00000000", b"00000000", b"0000000a", b"00000000", b"overlay.d\0",
+    b"070701", b"000493e2", b"000081a4", b"00000000", b"00000000", b"00000001", b"00000000", b"00000008",
+    b"00000000", b"00000000", b"00000000", b"00000000", b"00000012", b"00000000", b"overlay.d/init.rc\0",
+    b"on boot\n",
+    b"070701", b"000493e3", b"000041ed", b"00000000", b"000007d0", b"00000001", b"00000000", b"00000000",
+    b"00000000", b"00000000", b"00000000", b"00000000", b"00000005", b"00000000", b"sbin\0", b"\0",
+    b"070701", b"000493e4", b"000001ed", b"00000000", b"00000000", b"00000001", b"00000000", b"00000000",
+    b"00000000", b"00000000", b"00000000", b"00000000", b"0000000b", b"00000000", b"TRAILER!!!\0", b"\0\0\0",
+])
+
+@pytest.fixture
+def commands(tmp_path):
+    (tmp_path / "init.rc").write_bytes(INIT_RC); (tmp_path / "magiskinit").write_bytes(MAGISKINIT)
+    return [cmd.format(rc=tmp_path / "init.rc", init=tmp_path / "magiskinit") for cmd in COMMANDS]
+
+def parse_headers(buf):
+    """Yields (name, fields) for every entry of a newc archive, trailer included."""
+    pos = 0
+    while pos < len(buf):
+        fields = [int(buf[pos + 6 + i * 8:pos + 14 + i * 8], 16) for i in range(13)]
+        name = buf[pos + 110:pos + 110 + fields[11] - 1].decode()
+        yield name, fields
+        pos = wipt._align4(wipt._align4(pos + 110 + fields[11]) + fields[6])
+
+def test_dump_matches_golden(commands):
+    ramdisk = wipt.RamdiskCpio.parse(synthetic_ramdisk())
+    for cmd in commands: ramdisk.apply(cmd)
+    assert ramdisk.to_bytes() == GOLDEN
+
+def test_entries_sorted_with_magiskboot_inodes_nlink_and_trailer(commands):
+    ramdisk = wipt.RamdiskCpio.parse(synthetic_ramdisk())
+    for cmd in commands: ramdisk.apply(cmd)
+    headers = list(parse_headers(ramdisk.to_bytes()))
+    names = [name for name, _ in headers]
+    assert names[-1] == "TRAILER!!!" and names[:-1] == sorted(names[:-1])
+    assert [fields[0] for _, fields in headers] == list(range(300000, 300000 + len(headers)))
+    assert all(fields[4] == 1 and fields[5] == 0 for _, fields in headers) # nlink, mtime
+    assert headers[-1][1][1] == 0o755 and headers[-1][1][6] == 0
+
+def test_dump_is_stable_across_reparse(commands, tmp_path):
+    ramdisk = wipt.RamdiskCpio.parse(synthetic_ramdisk())
+    for cmd in commands: ramdisk.apply(cmd)
+    ramdisk.dump(tmp_path / "ramdisk.cpio")
+    assert wipt.RamdiskCpio.load(tmp_path / "ramdisk.cpio").to_bytes() == GOLDEN
+
+def test_paths_are_normalised_and_add_replaces(tmp_path):
+    (tmp_path / "a").write_bytes(b"a"); (tmp_path / "b").write_bytes(b"bb")
+    ramdisk = wipt.RamdiskCpio()
+    ramdisk.apply(f"add 0644 /overlay.d//x {tmp_path / 'a'}"); ramdisk.apply(f"add 0600 overlay.d/x {tmp_path / 'b'}")
+    assert list(ramdisk.entries) == ["overlay.d/x"]
+    assert ramdisk.entries["overlay.d/x"][0] == 0o100600 and ramdisk.entries["overlay.d/x"][5] == b"bb"
+
+def test_missing_archive_starts_empty(tmp_path):
+    assert list(parse_headers(wipt.RamdiskCpio.load(tmp_path / "missing.cpio").to_bytes())) == [
+        ("TRAILER!!!", [300000, 0o755, 0, 0, 1, 0, 0, 0, 0, 0, 0, 11, 0])]
+
+def test_rejects_unsupported_commands_and_bad_magic():
+    with pytest.raises(ValueError): wipt.RamdiskCpio().apply("patch")
+    with pytest.raises(ValueError): wipt.RamdiskCpio.parse(b"070707" + b"0" * 200)
+
+def _apply_fixture_case(case):
+    ramdisk = wipt.RamdiskCpio.load(os.path.join(FIXTURE_DIR, "input.cpio"))
+    for cmd in FIXTURE_CASES[case]: ramdisk.apply(cmd)
+    return ramdisk.to_bytes()
+
+@pytest.mark.parametrize("case", sorted(FIXTURE_CASES))
+def test_matches_magiskboot_fixture(case, monkeypatch):
+    monkeypatch.chdir(FIXTURE_DIR) # The command lists use paths relative to the fixture dir, as make_fixtures.py runs them
+    with open(os.path.join(FIXTURE_DIR, "expected", f"{case}.cpio"), 'rb') as f: assert _apply_fixture_case(case) == f.read()
+
+def test_fixture_inputs_are_current():
+    spec = importlib.util.spec_from_file_location("make_fixtures", os.path.join(FIXTURE_DIR, "make_fixtures.py"))
+    maker = importlib.util.module_from_spec(spec); spec.loader.exec_module(maker)
+    with open(os.path.join(FIXTURE_DIR, "input.cpio"), 'rb') as f: assert f.read() == maker.input_ramdisk()
+    for name, data in maker.FILES.items():
+        with open(os.path.join(FIXTURE_DIR, "files", name), 'rb') as f: assert f.read() == data
+
+def test_backup_compresses_changed_files_and_records_new_ones(monkeypatch):
+    monkeypatch.chdir(FIXTURE_DIR)
+    ramdisk = wipt.RamdiskCpio.load("input.cpio")
+    for cmd in FIXTURE_CASES["backup_xz"]: ramdisk.apply(cmd)
+    original = wipt.RamdiskCpio.load("input.cpio").entries
+    assert wipt.lzma.decompress(ramdisk.entries[".backup/init.xz"][5]) == original["init"][5]
+    assert wipt.lzma.decompress(ramdisk.entries[".backup/sbin/adbd.xz"][5]) == original["sbin/adbd"][5]
+    assert ramdisk.entries[".backup/sbin"][5] == b"" and ".backup/fstab.test.xz" not in ramdisk.entries
+    assert ".backup/.rmlist" not in ramdisk.entries # Nothing new: init was replaced, not added
+
+def test_mv_of_a_missing_entry_fails():
+    with pytest.raises(ValueError): wipt.RamdiskCpio().apply("mv nothing somewhere")
+
+def _magiskboot():
+    candidates = [os.environ.get("WIPT_TEST_MAGISKBOOT"), os.path.join(os.path.dirname(wipt.__file__), "vendor", "magisk-assets", "magiskboot")]
+    for path in filter(None, candidates):
+        if os.path.isfile(path) and os.path.getsize(path) and os.access(path, os.X_OK): return path
+    return None
+
+@pytest.mark.skipif(_magiskboot() is None, reason="no runnable magiskboot (set WIPT_TEST_MAGISKBOOT)")
+def test_matches_magiskboot(commands, tmp_path):
+    reference = tmp_path / "reference.cpio"; reference.write_bytes(synthetic_ramdisk())
+    subprocess.run([_magiskboot(), "cpio", str(reference)] + commands, check=True, capture_output=True)
+    ramdisk = wipt.RamdiskCpio.parse(synthetic_ramdisk())
+    for cmd in commands: ramdisk.apply(cmd)
+    assert ramdisk.to_bytes() == reference.read_bytes()
+
+@pytest.mark.skipif(_magiskboot() is None, reason="no runnable magiskboot (set WIPT_TEST_MAGISKBOOT)")
+@pytest.mark.parametrize("case", sorted(FIXTURE_CASES))
+def test_fixture_cases_match_magiskboot_live(case, monkeypatch, tmp_path):
+    monkeypatch.chdir(FIXTURE_DIR)
+    reference = tmp_path / "ramdisk.cpio"; shutil.copy("input.cpio", reference)
+    subprocess.run([_magiskboot(), "cpio", str(reference)] + FIXTURE_CASES[case], check=True, capture_output=True)
+    assert _apply_fixture_case(case) == reference.read_bytes()
@@ -0,0 +1,85 @@
+"""detect_format over one synthetic header per registered format, plus the cases a magic alone cannot settle."""
+import gzip
+import struct
+import zipfile
+
+import lz4.frame
+import pytest
+
+import synthetic
+import wipt
+
+def erofs():
+    head = bytearray(8192); struct.pack_into('<I', head, 1024, wipt.EROFS_SUPER_MAGIC); head[1024 + 12] = 12
+    struct.pack_into('<I', head, 1024 + 36, 100)
+    return bytes(head)
+
+def ext4():
+    head = bytearray(8192); struct.pack_into('<I', head, 1024 + 4, 256); struct.pack_into('<I', head, 1024 + 24, 2)
+    struct.pack_into('<H', head, 1024 + 0x38, wipt.EXT4_SUPER_MAGIC)
+    return bytes(head)
+
+def super_behind_crc_chunks():
+    """Sparse-wrapped super with CRC32 chunks between block 0 and the geometry, pushing it past the sniff window."""
+    raw, _ = synthetic.super_image({"system": [("linear", b"s" * 4096)]})
+    return synthetic.sparse_image([("raw", raw[:4096])] + [("crc32", i) for i in range(260)] + [("raw", raw[4096:])])[0]
+
+OTA_PAYLOAD = synthetic.payload({"boot": [(wipt.PAYLOAD_OP_REPLACE, bytes(4096), [(0, 1)])]})[0]
+TAR = synthetic.tar_archive({"boot.img": b"boot" * 300})
+BOOT_V2 = synthetic.boot_image(2)
+
+# (id, file name, contents, expected format, expected info subset)
+CASES = [
+    ("boot_v0", "boot.img", synthetic.boot_image(0), "boot", {"header_version": 0}),
+    ("boot_v2", "boot.img", BOOT_V2, "boot", {"header_version": 2, "page_size": 2048}),
+    ("boot_v4", "boot.img", synthetic.boot_image(4), "boot", {"header_version": 4, "page_size": 4096}),
+    ("vendor_boot_v4", "vendor_boot.img", synthetic.vendor_boot_image(4), "vendor_boot", {"header_version": 4}),
+    ("sparse", "system.img", synthetic.sparse_image([("raw", b"x" * 4096), ("dont_care", 10)])[0], "sparse", {"blocks": 11, "super": False}),
+    ("super", "super.img", synthetic.super_image({"system": [("linear", b"s" * 4096)]})[0], "super", {"slot_count": 2}),
+    ("sparse_wrapped_super", "super.img", synthetic.sparse_from_raw(synthetic.super_image({"system": [("linear", b"s" * 4096)]})[0]),
+     "super", {"container": "sparse", "super": True}),
+    ("sparse_super_geometry_out_of_window", "super.img", super_behind_crc_chunks(), "sparse", {"super": None}), # extract probes further
+    ("payload", "payload.bin", OTA_PAYLOAD, "payload", {"version": 2}),
+    ("lz4_frame", "boot.img.lz4", lz4.frame.compress(BOOT_V2, store_size=True), "lz4", {"legacy": False}),
+    ("lz4_legacy", "ramdisk.lz4", wipt.compress_ramdisk("lz4_legacy", b"ramdisk" * 100), "lz4", {"legacy": True}),
+    ("zip", "archive.zip", synthetic.ota_zip({"README.txt": (b"hello", zipfile.ZIP_DEFLATED)}), "zip", {"first_member": "README.txt"}),
+    ("ota_zip", "ota.zip", synthetic.ota_zip({"payload.bin": (OTA_PAYLOAD, zipfile.ZIP_STORED)}), "zip", {"first_member": "payload.bin"}),
+    ("gzip", "ramdisk.gz", gzip.compress(b"ramdisk" * 10), "gzip", {}),
+    ("tar", "AP_TEST.tar", TAR, "tar", {"first_member": "boot.img", "md5_trailer": False}),
+    ("tar_md5", "AP_TEST.tar.md5", synthetic.tar_archive({"boot.img": b"boot" * 300}, md5_name="AP_TEST.tar"), "tar",
+     {"first_member": "boot.img", "md5_trailer": True}),
+    ("erofs", "system.img", erofs(), "erofs", {"block_size": 4096, "blocks": 100}),
+    ("ext4", "vendor.img", ext4(), "ext4", {"block_size": 4096, "blocks": 256}),
+    ("brotli_framed", "system.new.dat.br", wipt.BROTLI_FRAMED_MAGIC + b"\0" * 16, "brotli", {"framed": True}),
+    ("truncated_boot", "boot.img", BOOT_V2[:1000], "unknown", {}), # Magic present, header cut short of the sniff window
+    ("truncated_tar", "AP_TEST.tar", TAR[:300], "unknown", {}),
+    ("empty", "boot.img", b"", "unknown", {}),
+]
+
+@pytest.mark.parametrize("name,data,expected,info", [case[1:] for case in CASES], ids=[case[0] for case in CASES])
+def test_detects_format(tmp_path, name, data, expected, info):
+    detected = wipt.detect_format(synthetic.write(tmp_path / name, data))
+    assert detected.format == expected
+    assert {key: detected.info.get(key) for key in info} == info
+    assert (detected.confidence > 0) == (expected != "unknown")
+
+def test_raw_brotli_needs_the_extension(tmp_path):
+    brotli = pytest.importorskip("brotli")
+    data = brotli.compress(b"block data" * 1000)
+    assert wipt.detect_format(synthetic.write(tmp_path / "system.new.dat.br", data)).format == "brotli"
+    assert wipt.detect_format(synthetic.write(tmp_path / "system.new.dat", data)).format == "unknown"
+
+@pytest.mark.parametrize("name,file_type", [("ota.zip", "ota.zip"), ("AP_TEST.tar.md5", "boot.tar"), ("boot.img.lz4", "boot.img.lz4"),
+                                            ("boot.img", "boot.img"), ("super.img", "super")])
+def test_pipeline_type_follows_the_content(tmp_path, name, file_type):
+    data = {case[1]: case[2] for case in reversed(CASES)}[name] # First case per file name
+    assert wipt.get_file_type(synthetic.write(tmp_path / name, data)) == file_type
+
+def test_sizes_come_from_headers(tmp_path):
+    assert wipt.detect_format(synthetic.write(tmp_path / "boot.img", BOOT_V2)).size == len(BOOT_V2)
+    assert wipt.detect_format(synthetic.write(tmp_path / "boot.img.lz4", lz4.frame.compress(BOOT_V2, store_size=True))).size == len(BOOT_V2)
+
+def test_extract_probes_for_super_past_the_window(tmp_path, capsys):
+    path = synthetic.write(tmp_path / "super.img", super_behind_crc_chunks())
+    wipt.handle_extract(wipt.argparse.Namespace(input=path, output=str(tmp_path / "out"), list=True, partitions=None, slot=0, workers=0, transfer_list=None))
+    assert "super image: LP metadata v10.0" in capsys.readouterr().out
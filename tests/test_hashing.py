@@ -0,0 +1,75 @@
+"""Hash ledger manifests and the Samsung .tar.md5 trailer: reading it, verifying an input's, and writing an output's."""
+import hashlib
+import io
+import json
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+import synthetic
+import wipt
+
+BOOT = synthetic.boot_image(2)
+MEMBERS = {"recovery.img.lz4": b"r" * 3000, "boot.img": BOOT, "vbmeta.img": b"v" * 700}
+
+@pytest.fixture(autouse=True)
+def ledger():
+    wipt.HASH_LEDGER.reset(); yield wipt.HASH_LEDGER; wipt.HASH_LEDGER.reset()
+
+def test_read_trailer(tmp_path):
+    data = synthetic.tar_archive(MEMBERS, md5_name="AP_TEST.tar")
+    tar_size = len(synthetic.tar_archive(MEMBERS))
+    assert wipt.read_tar_md5_trailer(synthetic.write(tmp_path / "AP_TEST.tar.md5", data)) == (tar_size, hashlib.md5(data[:tar_size]).hexdigest())
+    assert wipt.read_tar_md5_trailer(synthetic.write(tmp_path / "plain.tar", data[:tar_size])) is None
+    assert wipt.read_tar_md5_trailer(synthetic.write(tmp_path / "bad.tar.md5", data[:tar_size] + b"not-hex" * 5 + b"  AP.tar\n")) is None
+    assert wipt.read_tar_md5_trailer(synthetic.write(tmp_path / "cut.tar.md5", data[:-1])) is None # No closing newline
+
+def _repack(tmp_path, input_data, name="AP_TEST.tar.md5", tar_md5=False):
+    path = synthetic.write(tmp_path / name, input_data)
+    patched = synthetic.write(tmp_path / "work" / "boot.img", b"patched" + BOOT)
+    return wipt.repackage_patched_boot_image(patched, path, "boot.tar", str(tmp_path / "out"), original_boot_img_arcname="boot.img", tar_md5=tar_md5)
+
+def test_rewritten_trailer_matches_md5sum_of_the_tar(tmp_path, ledger):
+    output = _repack(tmp_path, synthetic.tar_archive(MEMBERS, md5_name="AP_TEST.tar"))
+    assert output.endswith("AP_TEST_patched.tar.md5")
+    with open(output, 'rb') as f: data = f.read()
+    tar_size, md5_hex = wipt.read_tar_md5_trailer(output)
+    assert data[tar_size:] == f"{md5_hex}  AP_TEST_patched.tar\n".encode() and hashlib.md5(data[:tar_size]).hexdigest() == md5_hex
+    with tarfile.open(fileobj=io.BytesIO(data[:tar_size])) as tar:
+        assert tar.getnames() == list(MEMBERS) and tar.extractfile("boot.img").read() == b"patched" + BOOT
+    assert ledger.entries["input"]["md5_trailer_ok"] is True and ledger.entries["output"]["md5"] == md5_hex
+    if shutil.which("md5sum"): # The trailer line is md5sum's own format, checked against the tar body under its own name
+        synthetic.write(tmp_path / "check" / "AP_TEST_patched.tar", data[:tar_size])
+        subprocess.run(["md5sum", "-c", "-"], input=data[tar_size:], cwd=tmp_path / "check", check=True, capture_output=True)
+
+def test_input_trailer_mismatch_is_reported(tmp_path, ledger, capsys):
+    data = bytearray(synthetic.tar_archive(MEMBERS, md5_name="AP_TEST.tar"))
+    data[-30] = ord("0") if data[-30] != ord("0") else ord("1") # A digit of the recorded MD5
+    output = _repack(tmp_path, bytes(data))
+    assert "Input MD5 trailer mismatch" in capsys.readouterr().out and ledger.entries["input"]["md5_trailer_ok"] is False
+    tar_size, md5_hex = wipt.read_tar_md5_trailer(output) # The output still gets a correct trailer of its own
+    with open(output, 'rb') as f: assert hashlib.md5(f.read(tar_size)).hexdigest() == md5_hex
+
+def test_plain_tar_gets_a_trailer_on_request(tmp_path):
+    output = _repack(tmp_path, synthetic.tar_archive(MEMBERS), name="AP_TEST.tar", tar_md5=True)
+    tar_size, md5_hex = wipt.read_tar_md5_trailer(output)
+    with open(output, 'rb') as f: assert hashlib.md5(f.read(tar_size)).hexdigest() == md5_hex
+    assert wipt.read_tar_md5_trailer(_repack(tmp_path, synthetic.tar_archive(MEMBERS), name="AP_TEST.tar")) is None
+
+def test_manifest_names_temp_files_relatively(tmp_path, ledger):
+    output = _repack(tmp_path, synthetic.tar_archive(MEMBERS, md5_name="AP_TEST.tar"))
+    ledger.record("boot_image", str(tmp_path / "work" / "boot.img"), wipt.hash_file(str(tmp_path / "work" / "boot.img")))
+    with open(ledger.write_manifest(output, patcher="magisk", boot_image_arcname="boot.img"), encoding='utf-8') as f: manifest = json.load(f)
+    assert manifest["boot_image"]["path"] == manifest["patched"]["path"] == "boot.img" and manifest["boot_image_arcname"] == "boot.img"
+    assert manifest["input"]["path"] == str(tmp_path / "AP_TEST.tar.md5") and manifest["output"]["path"] == output
+    with open(ledger.write_manifest(output), encoding='utf-8') as f: assert json.load(f)["patched"]["path"] == "boot.img" # Basename fallback
+
+def test_pipeline_manifest_has_no_temp_paths(tmp_path):
+    image = synthetic.write(tmp_path / "boot.img", BOOT)
+    output = wipt.run_patch_pipeline(image, str(tmp_path / "out"), None, {})
+    with open(output + ".manifest.json", encoding='utf-8') as f: manifest = json.load(f)
+    assert manifest["input"]["path"] == image and manifest["output"]["path"] == output
+    assert manifest["boot_image"]["path"] == manifest["patched"]["path"] == "boot.img"
+    assert manifest["boot_image"]["sha256"] == manifest["output"]["sha256"] == hashlib.sha256(BOOT).hexdigest()
@@ -0,0 +1,83 @@
+import io
+import os
+import shutil
+import subprocess
+
+import lz4.frame
+import pytest
+
+import wipt
+
+BLOCK_SIZES = sorted(wipt.LZ4_BLOCK_SIZE_IDS)
+FRAME_BLOCK_SIZES = {64 * 1024: lz4.frame.BLOCKSIZE_MAX64KB, 256 * 1024: lz4.frame.BLOCKSIZE_MAX256KB,
+                     1024 * 1024: lz4.frame.BLOCKSIZE_MAX1MB, 4 * 1024 * 1024: lz4.frame.BLOCKSIZE_MAX4MB}
+
+def payload(size, seed=0):
+    """Half compressible text, half random bytes, so both compressed and stored (raw) blocks occur."""
+    text = (b"android boot image %d " % seed) * (size // 40 + 1)
+    noise = os.urandom(size // 2)
+    return (text[:size - len(noise)] + noise)[:size]
+
+def sizes(block_size): return [0, 1, block_size - 1, block_size, block_size * 2 + 17]
+
+def write_frame(data, block_size, level=0, workers=2, chunks=3):
+    out = io.BytesIO()
+    with wipt.ParallelLZ4Writer(out, block_size=block_size, level=level, workers=workers) as writer:
+        step = max(1, len(data) // chunks)
+        for start in range(0, len(data), step): writer.write(data[start:start + step])
+    return out.getvalue()
+
+def read_frame(frame, workers=2, read_size=-1):
+    with wipt.ParallelLZ4Reader(io.BytesIO(frame), workers=workers) as reader:
+        if read_size < 0: return reader.read()
+        return b"".join(iter(lambda: reader.read(read_size), b""))
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+@pytest.mark.parametrize("level,workers", [(0, 1), (0, 3), (9, 2)])
+def test_writer_output_decodes_with_lz4_frame(block_size, level, workers):
+    for size in sizes(block_size):
+        data = payload(size, size)
+        frame = write_frame(data, block_size, level, workers)
+        assert lz4.frame.decompress(frame) == data, size
+        assert read_frame(frame) == data, size
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+@pytest.mark.parametrize("linked", [False, True])
+@pytest.mark.parametrize("checksums", [(False, False), (True, False), (False, True), (True, True)])
+def test_reader_decodes_lz4_frame_output(block_size, linked, checksums):
+    content_checksum, block_checksum = checksums
+    for size in sizes(block_size):
+        data = payload(size, size)
+        frame = lz4.frame.compress(data, block_size=FRAME_BLOCK_SIZES[block_size], block_linked=linked, store_size=size % 2 == 0,
+                                   content_checksum=content_checksum, block_checksum=block_checksum)
+        assert read_frame(frame, workers=1) == data, size
+        assert read_frame(frame, workers=3, read_size=65537) == data, size
+
+def test_concatenated_and_skippable_frames():
+    first, second = payload(100000, 1), payload(5000, 2)
+    skippable = (0x184D2A53).to_bytes(4, 'little') + (3).to_bytes(4, 'little') + b"xyz"
+    frame = lz4.frame.compress(first, block_linked=True) + skippable + write_frame(second, 64 * 1024)
+    assert read_frame(frame) == first + second
+
+def test_corrupt_header_checksum_raises():
+    frame = bytearray(lz4.frame.compress(b"payload" * 1000, store_size=True))
+    frame[4 + 2 + 8] ^= 0xFF # FLG, BD, content size, then the header checksum byte
+    with pytest.raises(ValueError, match="header"): read_frame(bytes(frame))
+    frame = bytearray(write_frame(b"x", 64 * 1024))
+    frame[4 + 2] ^= 0x01 # No content size in our own frames: FLG, BD, then the checksum
+    with pytest.raises(ValueError, match="header"): read_frame(bytes(frame))
+
+def test_truncated_frame_raises():
+    frame = write_frame(payload(300000), 64 * 1024)
+    with pytest.raises(EOFError): read_frame(frame[:len(frame) // 2])
+
+def test_xxh32_known_vectors():
+    assert wipt._xxh32(b"") == 0x02CC5D05
+    assert wipt._xxh32(b"abc") == 0x32D153FF
+    assert wipt._xxh32(b"Nobody inspects the spammish repetition") == 0xE2293B2F # >= 16 bytes: the four-lane path
+
+@pytest.mark.skipif(shutil.which("lz4") is None, reason="lz4 CLI not installed")
+def test_lz4_cli_accepts_writer_output(tmp_path):
+    path = tmp_path / "out.lz4"
+    path.write_bytes(write_frame(payload(3 * 1024 * 1024), 1024 * 1024))
+    subprocess.run(["lz4", "-t", str(path)], check=True, capture_output=True)
@@ -0,0 +1,80 @@
+"""Boot image extraction from OTA zips built in the test: a stored payload.bin decoded in place, a deflated one
+inflated first, and a Samsung AP_*.tar.md5."""
+import os
+import zipfile
+
+import pytest
+
+import synthetic
+import wipt
+
+BLOCK = 4096
+
+@pytest.fixture(autouse=True)
+def ledger():
+    wipt.HASH_LEDGER.reset(); yield wipt.HASH_LEDGER; wipt.HASH_LEDGER.reset()
+
+def boot_partition():
+    """A v2 boot image padded to whole blocks, as payload partitions are, and a payload holding it next to system."""
+    boot = synthetic.boot_image(2)
+    boot += bytes(-len(boot) % BLOCK)
+    return boot, synthetic.payload({"system": [(wipt.PAYLOAD_OP_REPLACE_XZ, b"system" * BLOCK, [(0, 6)])],
+                                    "boot": [(wipt.PAYLOAD_OP_REPLACE_BZ, boot, [(0, len(boot) // BLOCK)])]})[0]
+
+def _ota(tmp_path, members):
+    return synthetic.write(tmp_path / "ota.zip", synthetic.ota_zip(members))
+
+@pytest.mark.parametrize("compress_type", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_payload_boot_partition(compress_type, tmp_path, ledger):
+    boot, payload = boot_partition()
+    path = _ota(tmp_path, {"META-INF/com/android/metadata": (b"ota-type=AB\n", zipfile.ZIP_DEFLATED), "payload.bin": (payload, compress_type),
+                           "payload_properties.txt": (b"FILE_HASH=x\n", zipfile.ZIP_STORED)})
+    (tmp_path / "work").mkdir()
+    dest, source = wipt._extract_boot_from_ota_zip(path, str(tmp_path / "work"))
+    assert source == "payload.bin:boot" and dest == str(tmp_path / "work" / "boot.img")
+    assert (tmp_path / "work" / "boot.img").read_bytes() == boot
+    assert os.listdir(tmp_path / "work") == ["boot.img"] # An inflated payload copy is removed again
+    assert ledger.sha256("boot_image") == wipt.hashlib.sha256(boot).hexdigest()
+
+def test_stored_payload_is_read_in_place(tmp_path, monkeypatch):
+    boot, payload = boot_partition()
+    path = _ota(tmp_path, {"payload.bin": (payload, zipfile.ZIP_STORED)})
+    opened, real_init = [], wipt.PayloadFile.__init__
+    def recording_init(self, payload_path, offset=0): opened.append((payload_path, offset)); real_init(self, payload_path, offset)
+    monkeypatch.setattr(wipt.PayloadFile, "__init__", recording_init)
+    (tmp_path / "work").mkdir()
+    wipt._extract_boot_from_ota_zip(path, str(tmp_path / "work"))
+    with open(path, 'rb') as f: assert opened == [(path, f.read().index(wipt.PAYLOAD_MAGIC))] # Mapped straight out of the zip
+
+def test_ap_tar_md5(tmp_path, ledger):
+    boot = synthetic.boot_image(0)
+    ap = synthetic.tar_archive({"recovery.img": b"recovery", "boot.img": boot, "vbmeta.img": b"v" * 100}, md5_name="AP_TEST.tar")
+    path = _ota(tmp_path, {"BL_TEST.tar.md5": (synthetic.tar_archive({"sboot.bin": b"bl"}, "BL_TEST.tar"), zipfile.ZIP_DEFLATED),
+                           "AP_TEST.tar.md5": (ap, zipfile.ZIP_DEFLATED)})
+    (tmp_path / "work").mkdir()
+    assert wipt._extract_boot_from_ota_zip(path, str(tmp_path / "work"))[1] == "AP_TEST.tar.md5:recovery.img" # The first preferred name in archive order wins
+    (tmp_path / "work2").mkdir()
+    ap = synthetic.tar_archive({"vbmeta.img": b"v" * 100, "boot.img": boot}, md5_name="AP_TEST.tar")
+    path = _ota(tmp_path, {"AP_TEST.tar.md5": (ap, zipfile.ZIP_STORED)})
+    dest, source = wipt._extract_boot_from_ota_zip(path, str(tmp_path / "work2"))
+    assert source == "AP_TEST.tar.md5:boot.img" and open(dest, 'rb').read() == boot
+    assert os.listdir(tmp_path / "work2") == ["boot.img"] # The generic .img fallback is dropped once boot.img turns up
+    assert ledger.sha256("boot_image") == wipt.hashlib.sha256(boot).hexdigest()
+
+def test_boot_member_wins_over_payload(tmp_path):
+    boot, payload = boot_partition()
+    path = _ota(tmp_path, {"payload.bin": (payload, zipfile.ZIP_STORED), "images/boot.img": (b"direct" + boot, zipfile.ZIP_DEFLATED)})
+    (tmp_path / "work").mkdir()
+    dest, source = wipt._extract_boot_from_ota_zip(path, str(tmp_path / "work"))
+    assert source == "images/boot.img" and open(dest, 'rb').read() == b"direct" + boot
+
+def test_prepare_reports_ota_zip(tmp_path):
+    boot, payload = boot_partition()
+    path = _ota(tmp_path, {"payload.bin": (payload, zipfile.ZIP_STORED)})
+    plain, file_type, temp_dir, arcname = wipt.prepare_boot_image_for_patching(path)
+    try: assert (file_type, arcname) == ("ota.zip", "boot.img") and open(plain, 'rb').read() == boot
+    finally: wipt.shutil.rmtree(temp_dir)
+
+def test_zip_without_a_boot_image(tmp_path):
+    path = _ota(tmp_path, {"README": (b"nothing here", zipfile.ZIP_DEFLATED)})
+    with pytest.raises(Exception, match="No boot image"): wipt.prepare_boot_image_for_patching(path)
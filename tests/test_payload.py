@@ -0,0 +1,78 @@
+"""PayloadFile over synthetic payload.bin files: manifest walk, REPLACE/REPLACE_BZ/REPLACE_XZ/ZERO operations and
+--partitions filtering in the extract command."""
+import pytest
+
+import synthetic
+import wipt
+
+BLOCK = 4096
+PARTITIONS = {
+    "boot": [(wipt.PAYLOAD_OP_REPLACE, b"boot" * (2 * BLOCK // 4), [(0, 2)]), (wipt.PAYLOAD_OP_REPLACE_BZ, b"B" * BLOCK, [(2, 1)])],
+    "system": [(wipt.PAYLOAD_OP_REPLACE_XZ, bytes(range(256)) * 48, [(5, 1), (0, 2)]), (wipt.PAYLOAD_OP_ZERO, None, [(2, 3)]),
+               (wipt.PAYLOAD_OP_REPLACE, b"end!" * BLOCK, [(6, 4)]), (wipt.PAYLOAD_OP_DISCARD, None, [(10, 6)])],
+    "vendor": [(wipt.PAYLOAD_OP_REPLACE_BZ, b"vendor" * 2000 + bytes(-12000 % BLOCK), [(0, 3)])],
+}
+
+@pytest.fixture
+def payload(tmp_path):
+    data, contents = synthetic.payload(PARTITIONS)
+    return synthetic.write(tmp_path / "payload.bin", data), contents
+
+def _namespace(path, output, **overrides):
+    return wipt.argparse.Namespace(**dict(dict(input=path, output=output, list=False, partitions=None, slot=0, workers=0, transfer_list=None), **overrides))
+
+def test_manifest_walk(payload):
+    path, contents = payload
+    with wipt.PayloadFile(path) as payload_file:
+        assert payload_file.block_size == BLOCK and list(payload_file.partitions) == list(PARTITIONS)
+        assert {name: p["size"] for name, p in payload_file.partitions.items()} == {name: len(data) for name, data in contents.items()}
+        system = payload_file.partitions["system"]["operations"]
+        assert [op["type"] for op in system] == [op_type for op_type, _, _ in PARTITIONS["system"]]
+        assert system[0]["dst_extents"] == [(5, 1), (0, 2)] and system[1]["data_length"] == 0
+
+def test_size_falls_back_to_the_extents(tmp_path):
+    data, contents = synthetic.payload(PARTITIONS, with_sizes=False)
+    with wipt.PayloadFile(synthetic.write(tmp_path / "payload.bin", data)) as payload_file:
+        assert payload_file.partitions["system"]["size"] == len(contents["system"]) == 16 * BLOCK
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_operations_decode_to_their_extents(payload, tmp_path, workers):
+    path, contents = payload
+    with wipt.PayloadFile(path) as payload_file:
+        for name in PARTITIONS:
+            written = payload_file.extract(name, str(tmp_path / f"{name}.img"), workers)
+            assert (tmp_path / f"{name}.img").read_bytes() == contents[name], name
+            assert written == sum(len(data) for _, data, _ in PARTITIONS[name] if data is not None)
+
+def test_zero_and_discard_stay_holes(payload, tmp_path):
+    path, contents = payload
+    with wipt.PayloadFile(path) as payload_file: payload_file.extract("system", str(tmp_path / "system.img"))
+    assert synthetic.allocated_bytes(tmp_path / "system.img") <= 7 * BLOCK # 16 blocks, 9 of them zeroed or discarded
+
+def test_payload_at_an_offset(payload, tmp_path):
+    path, contents = payload
+    with open(path, 'rb') as f: data = f.read()
+    wrapped = synthetic.write(tmp_path / "wrapped.bin", b"\0" * 1000 + data)
+    with wipt.PayloadFile(wrapped, offset=1000) as payload_file: payload_file.extract("vendor", str(tmp_path / "vendor.img"))
+    assert (tmp_path / "vendor.img").read_bytes() == contents["vendor"]
+
+def test_extract_command_filters_partitions(payload, tmp_path, capsys):
+    path, contents = payload
+    wipt.handle_extract(_namespace(path, str(tmp_path / "out"), partitions="vendor, boot"))
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == ["boot.img", "vendor.img"]
+    assert (tmp_path / "out" / "boot.img").read_bytes() == contents["boot"]
+    wipt.handle_extract(_namespace(path, str(tmp_path / "listed"), list=True))
+    out = capsys.readouterr().out
+    assert "3 partition(s)" in out and "4 ops" in out and list((tmp_path / "listed").iterdir()) == []
+
+def test_incremental_operations_are_rejected(tmp_path):
+    data, _ = synthetic.payload({"boot": [(wipt.PAYLOAD_OP_REPLACE, bytes(BLOCK), [(0, 1)])]})
+    data = data.replace(synthetic._pb(1, wipt.PAYLOAD_OP_REPLACE) + synthetic._pb(6, synthetic._pb(1, 0) + synthetic._pb(2, 1)),
+                        synthetic._pb(1, 4) + synthetic._pb(6, synthetic._pb(1, 0) + synthetic._pb(2, 1))) # SOURCE_COPY
+    with wipt.PayloadFile(synthetic.write(tmp_path / "payload.bin", data)) as payload_file:
+        with pytest.raises(ValueError, match="SOURCE_COPY"): payload_file.extract("boot", str(tmp_path / "boot.img"))
+        with pytest.raises(ValueError, match="not in payload"): payload_file.extract("odm", str(tmp_path / "odm.img"))
+
+def test_rejects_non_payloads(tmp_path):
+    with pytest.raises(ValueError, match="CrAU"): wipt.PayloadFile(synthetic.write(tmp_path / "x.bin", b"\0" * 64))
+    with pytest.raises(ValueError, match="version"): wipt.PayloadFile(synthetic.write(tmp_path / "v1.bin", b"CrAU" + (1).to_bytes(8, 'big') + bytes(64)))
@@ -0,0 +1,40 @@
+"""Stage records from StageProfiler: every stage counted once, with bytes in and out, for both XZ engines."""
+import pytest
+
+import synthetic
+import wipt
+
+@pytest.fixture
+def profiler(monkeypatch):
+    profiler = wipt.StageProfiler(); profiler.enable(job="test")
+    monkeypatch.setattr(wipt, "PROFILER", profiler)
+    return profiler
+
+def _patch(tmp_path, monkeypatch, **options):
+    monkeypatch.chdir(tmp_path); synthetic.magisk_workspace(tmp_path)
+    image = synthetic.write(tmp_path / "boot.img", synthetic.boot_image(2))
+    options = dict({"XZ_CACHE": False, "UNPACK_CACHE": False}, **options)
+    return wipt.run_patch_pipeline(image, str(tmp_path / "out"), "magisk", options)
+
+def _stages(profiler): return [rec["stage"] for rec in profiler.records]
+
+def test_python_engines(tmp_path, monkeypatch, profiler):
+    _patch(tmp_path, monkeypatch)
+    assert _stages(profiler) == ["prepare", "xz", "xz", "xz", "bootimg in-process", "repackage"]
+    assert all(rec["ok"] and rec["bytes_in"] and rec["bytes_out"] for rec in profiler.records)
+
+def test_magiskboot_xz_is_not_counted_twice(tmp_path, monkeypatch, profiler):
+    _patch(tmp_path, monkeypatch, XZ_ENGINE="magiskboot")
+    assert _stages(profiler) == ["prepare", "magiskboot xz", "magiskboot xz", "magiskboot xz", "bootimg in-process", "repackage"]
+    xz = [rec for rec in profiler.records if rec["stage"] == "magiskboot xz"]
+    assert all(0 < rec["bytes_out"] < rec["bytes_in"] for rec in xz)
+    table = wipt.format_profile_table(profiler.records)
+    assert "magiskboot xz" in table and "\nxz " not in table
+
+def test_magiskboot_stages_report_bytes_out(tmp_path, monkeypatch, profiler):
+    output = _patch(tmp_path, monkeypatch, BOOTIMG_ENGINE="magiskboot", CPIO_ENGINE="magiskboot")
+    records = {rec["stage"]: rec for rec in profiler.records}
+    assert [stage for stage in _stages(profiler) if stage.startswith("magiskboot")] == ["magiskboot unpack", "magiskboot cpio", "magiskboot repack"]
+    assert records["magiskboot unpack"]["bytes_out"] > records["magiskboot cpio"]["bytes_in"] # ramdisk.cpio plus kernel, second, ...
+    assert records["magiskboot cpio"]["bytes_out"] > records["magiskboot cpio"]["bytes_in"] # The payloads were added
+    assert records["magiskboot repack"]["bytes_out"] == wipt.os.path.getsize(output)
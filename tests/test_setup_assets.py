@@ -0,0 +1,110 @@
+"""AssetManager against a local stand-in for the GitHub release API and its asset downloads."""
+import hashlib
+import http.server
+import json
+import threading
+
+import pytest
+
+import setup
+
+APK = bytes(range(256)) * 64 + b"tail" # Not a multiple of anything, so resume offsets are easy to get wrong
+EXTRA = b"magiskboot.exe stand-in" * 100
+
+class ReleaseServer(http.server.ThreadingHTTPServer):
+    """/release answers with a release JSON (ETag, 304 on If-None-Match); /<name> serves a file with Range,
+    If-Range and 416 handling. Every request's path and headers are recorded."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ReleaseHandler)
+        self.files = {"Magisk.apk": APK, "magiskboot.exe": EXTRA}
+        self.etags = {name: f'"{hashlib.sha256(data).hexdigest()[:16]}"' for name, data in self.files.items()}
+        self.release_etag, self.requests = '"release-1"', []
+        self.base = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def release(self):
+        return {"tag_name": "v99.0", "assets": [{"name": name, "size": len(data), "browser_download_url": f"{self.base}/{name}",
+                                                 "digest": "sha256:" + hashlib.sha256(data).hexdigest()} for name, data in self.files.items()]}
+
+class ReleaseHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items(): self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server; server.requests.append((self.path, dict(self.headers)))
+        if self.path == "/release":
+            if self.headers.get("If-None-Match") == server.release_etag: return self._send(304)
+            return self._send(200, json.dumps(server.release()).encode(), {"ETag": server.release_etag})
+        name = self.path.lstrip("/")
+        if name not in server.files: return self._send(404)
+        data, etag, range_header = server.files[name], server.etags[name], self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") in (None, etag):
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(data): return self._send(416, headers={"Content-Range": f"bytes */{len(data)}"})
+            return self._send(206, data[start:], {"ETag": etag, "Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"})
+        self._send(200, data, {"ETag": etag})
+
+@pytest.fixture
+def server():
+    server = ReleaseServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True); thread.start()
+    yield server
+    server.shutdown(); server.server_close()
+
+def _item(server, name="Magisk.apk"):
+    data = server.files[name]
+    return {"name": name, "url": f"{server.base}/{name}", "size": len(data), "sha256": hashlib.sha256(data).hexdigest(), "tag": "v99.0"}
+
+def _write_part(asset_dir, name, data, url, etag):
+    (asset_dir / (name + ".part")).write_bytes(data)
+    (asset_dir / (name + ".part.json")).write_text(json.dumps({"url": url, "etag": etag}))
+
+def test_truncated_part_resumes_with_range(server, tmp_path):
+    item = _item(server)
+    _write_part(tmp_path, "Magisk.apk", APK[:5000], item["url"], server.etags["Magisk.apk"])
+    manager = setup.AssetManager(str(tmp_path))
+    assert manager.download(**item) == str(tmp_path / "Magisk.apk")
+    assert (tmp_path / "Magisk.apk").read_bytes() == APK and setup.sha256_file(str(tmp_path / "Magisk.apk")) == item["sha256"]
+    (path, headers), = server.requests
+    assert headers["Range"] == "bytes=5000-" and headers["If-Range"] == server.etags["Magisk.apk"]
+    assert manager.bytes_downloaded == len(APK) - 5000
+    assert not (tmp_path / "Magisk.apk.part").exists() and not (tmp_path / "Magisk.apk.part.json").exists()
+
+def test_changed_etag_restarts_from_zero(server, tmp_path):
+    item = _item(server)
+    _write_part(tmp_path, "Magisk.apk", b"stale bytes of an older build" * 10, item["url"], '"older-build"')
+    manager = setup.AssetManager(str(tmp_path))
+    assert manager.download(**item) and (tmp_path / "Magisk.apk").read_bytes() == APK
+    assert server.requests[0][1]["If-Range"] == '"older-build"' and manager.bytes_downloaded == len(APK)
+
+def test_416_discards_the_part_and_restarts(server, tmp_path):
+    item = _item(server)
+    _write_part(tmp_path, "Magisk.apk", b"x" * (len(APK) + 10), item["url"], server.etags["Magisk.apk"])
+    manager = setup.AssetManager(str(tmp_path))
+    assert manager.download(**item) and (tmp_path / "Magisk.apk").read_bytes() == APK
+    assert [("Range" in headers) for _, headers in server.requests] == [True, False]
+    assert not (tmp_path / "Magisk.apk.part").exists() and not (tmp_path / "Magisk.apk.part.json").exists()
+
+def test_416_on_a_complete_part_finalizes_it(server, tmp_path):
+    item = _item(server)
+    _write_part(tmp_path, "Magisk.apk", APK, item["url"], server.etags["Magisk.apk"])
+    manager = setup.AssetManager(str(tmp_path))
+    assert manager.download(**item) and (tmp_path / "Magisk.apk").read_bytes() == APK
+    assert len(server.requests) == 1 and manager.bytes_downloaded == 0
+
+def test_warm_run_gets_304_and_transfers_nothing(server, tmp_path):
+    cold = setup.AssetManager(str(tmp_path))
+    release = cold.fetch_release(f"{server.base}/release")
+    items = [{"name": a["name"], "url": a["browser_download_url"], "size": a["size"], "sha256": setup.release_asset_sha256(a),
+              "tag": release["tag_name"]} for a in release["assets"]]
+    assert all(cold.fetch_all(items).values()) and cold.bytes_downloaded == len(APK) + len(EXTRA)
+    server.requests.clear()
+    warm = setup.AssetManager(str(tmp_path)) # A new run: only the state file carries over
+    assert warm.fetch_release(f"{server.base}/release") == release
+    assert all(warm.fetch_all(items).values())
+    (path, headers), = server.requests
+    assert path == "/release" and headers["If-None-Match"] == server.release_etag
+    assert warm.requests_made == 1 and warm.bytes_downloaded == 0
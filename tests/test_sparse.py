@@ -0,0 +1,66 @@
+"""Sparse image decoding: unsparse_image and SparseImageView over RAW, FILL, DONT_CARE and CRC32 chunks."""
+import io
+import os
+import struct
+
+import pytest
+
+import synthetic
+import wipt
+
+BLOCK = 4096
+CHUNKS = [("raw", bytes(range(256)) * 32), ("dont_care", 256), ("fill", b"\xa5\x5a\x0f\xf0", 3), ("crc32", 0x12345678),
+          ("fill", b"\0\0\0\0", 128), ("raw", b"tail" * 2048), ("dont_care", 64)]
+
+@pytest.fixture
+def image(tmp_path):
+    sparse, raw = synthetic.sparse_image(CHUNKS, BLOCK)
+    return synthetic.write(tmp_path / "system.sparse.img", sparse), raw
+
+def test_unsparse_matches_raw_and_counts_chunks(image, tmp_path):
+    path, raw = image
+    stats = wipt.unsparse_image(path, str(tmp_path / "system.img"))
+    assert (tmp_path / "system.img").read_bytes() == raw
+    assert stats == {"raw_bytes": 4 * BLOCK, "fill_bytes": 3 * BLOCK, "hole_bytes": (256 + 128 + 64) * BLOCK, "chunks": len(CHUNKS)}
+
+def test_dont_care_and_zero_fill_stay_holes(image, tmp_path):
+    path, raw = image
+    wipt.unsparse_image(path, str(tmp_path / "system.img"))
+    data_bytes = (4 + 3) * BLOCK
+    assert os.path.getsize(tmp_path / "system.img") == len(raw)
+    assert synthetic.allocated_bytes(tmp_path / "system.img") <= data_bytes + 4 * BLOCK # Slack for filesystem rounding
+
+def test_view_reads_any_range(image):
+    path, raw = image
+    view = wipt.SparseImageView(path)
+    try:
+        assert view.size == len(raw)
+        for offset, length in [(0, 10), (BLOCK * 8 - 3, 10), (BLOCK * 264 + 1, 3 * BLOCK), (BLOCK * 266, 200 * BLOCK), (len(raw) - 5, 100)]:
+            assert view.pread(offset, length) == raw[offset:offset + length], (offset, length)
+    finally: view.close()
+
+def test_view_copy_leaves_holes(image, tmp_path):
+    path, raw = image
+    view = wipt.SparseImageView(path)
+    try:
+        with open(tmp_path / "copy.img", 'wb') as f_out:
+            view.copy_to(f_out, 0, 0, view.size, bytearray(wipt.SPARSE_IO_CHUNK)); f_out.truncate(view.size)
+    finally: view.close()
+    assert (tmp_path / "copy.img").read_bytes() == raw
+    assert synthetic.allocated_bytes(tmp_path / "copy.img") <= 11 * BLOCK
+
+def test_extract_command_writes_raw_image(image, tmp_path, capsys):
+    path, raw = image
+    wipt.handle_extract(wipt.argparse.Namespace(input=path, output=str(tmp_path / "out"), list=False, partitions=None, slot=0, workers=0, transfer_list=None))
+    assert "Detected sparse" in capsys.readouterr().out
+    assert (tmp_path / "out" / "system.img").read_bytes() == raw
+
+def test_rejects_corrupt_images(tmp_path):
+    sparse, _ = synthetic.sparse_image(CHUNKS, BLOCK)
+    bad_type = bytearray(sparse); struct.pack_into('<H', bad_type, 28, 0xCAFF)
+    bad_size = bytearray(sparse); struct.pack_into('<I', bad_size, 28 + 4, 3) # First RAW chunk claims 3 blocks, carries 2
+    short_total = bytearray(sparse); struct.pack_into('<I', short_total, 16, 1000)
+    for name, data, error in [("type", bad_type, ValueError), ("size", bad_size, ValueError), ("total", short_total, ValueError),
+                              ("truncated", sparse[:28 + 12 + 4096], EOFError), ("magic", b"\0" * 64, ValueError)]:
+        path = synthetic.write(tmp_path / f"{name}.img", bytes(data))
+        with pytest.raises(error): wipt.unsparse_image(path, str(tmp_path / "out.img"))
@@ -0,0 +1,92 @@
+"""SuperImage over synthetic liblp images: extent mapping, ZERO extents, empty partitions, checksum validation and
+super images wrapped in a sparse container."""
+import io
+
+import pytest
+
+import synthetic
+import wipt
+
+BLOCK = 4096
+PARTITIONS = {
+    "system": [("linear", b"S1" * (3 * BLOCK // 2)), ("zero", 2 * BLOCK), ("linear", b"S2" * BLOCK)],
+    "vendor": [("linear", bytes(range(256)) * 16), ("linear", b"V2" * (BLOCK // 2))],
+    "odm": [],
+}
+PRIMARY_HEADER = wipt.LP_PARTITION_RESERVED_BYTES + 2 * wipt.LP_METADATA_GEOMETRY_SIZE
+
+@pytest.fixture
+def image(tmp_path):
+    data, contents = synthetic.super_image(PARTITIONS)
+    return synthetic.write(tmp_path / "super.img", data), contents
+
+def _namespace(path, output, **overrides):
+    return wipt.argparse.Namespace(**dict(dict(input=path, output=output, list=False, partitions=None, slot=0, workers=0, transfer_list=None), **overrides))
+
+def test_index_lists_partitions_and_extents(image):
+    path, contents = image
+    with wipt.SuperImage(path) as super_image:
+        assert list(super_image.partitions) == ["system", "vendor", "odm"]
+        assert {name: p["size"] for name, p in super_image.partitions.items()} == {name: len(data) for name, data in contents.items()}
+        system = super_image.partitions["system"]
+        assert [extent[2] for extent in system["extents"]] == [wipt.LP_TARGET_TYPE_LINEAR, wipt.LP_TARGET_TYPE_ZERO, wipt.LP_TARGET_TYPE_LINEAR]
+        assert system["group"] == "main" and system["attributes"] == wipt.LP_PARTITION_ATTR_READONLY
+        assert super_image.groups == ["default", "main"] and super_image.block_devices[0]["name"] == "super"
+
+def test_multi_extent_partitions_extract_and_read_lazily(image, tmp_path):
+    path, contents = image
+    with wipt.SuperImage(path) as super_image:
+        for name in ("system", "vendor"):
+            assert super_image.extract(name, str(tmp_path / f"{name}.img")) == len(contents[name])
+            assert (tmp_path / f"{name}.img").read_bytes() == contents[name]
+            reader = io.BufferedReader(super_image.open(name))
+            reader.seek(BLOCK * 3 - 7); assert reader.read(BLOCK + 14) == contents[name][BLOCK * 3 - 7:BLOCK * 4 + 7] # Across an extent boundary
+            reader.seek(0); assert reader.read() == contents[name]
+
+def test_zero_extent_is_a_hole(image, tmp_path):
+    path, contents = image
+    with wipt.SuperImage(path) as super_image: super_image.extract("system", str(tmp_path / "system.img"))
+    assert contents["system"][3 * BLOCK:5 * BLOCK] == bytes(2 * BLOCK)
+    assert synthetic.allocated_bytes(tmp_path / "system.img") <= len(contents["system"]) - 2 * BLOCK
+
+def test_empty_partition(image, tmp_path):
+    path, _ = image
+    with wipt.SuperImage(path) as super_image:
+        assert super_image.partitions["odm"] == {"size": 0, "attributes": wipt.LP_PARTITION_ATTR_READONLY, "extents": [], "group": "main"}
+        assert super_image.extract("odm", str(tmp_path / "odm.img")) == 0 and super_image.open("odm").read() == b""
+    wipt.handle_extract(_namespace(path, str(tmp_path / "out")))
+    assert sorted(p.name for p in (tmp_path / "out").iterdir()) == ["system.img", "vendor.img"] # Empty partitions are skipped by default
+
+def _corrupt(data, offset):
+    data = bytearray(data); data[offset] ^= 0xFF
+    return bytes(data)
+
+def test_bad_geometry_checksum(tmp_path):
+    data, contents = synthetic.super_image(PARTITIONS)
+    primary, backup = wipt.LP_PARTITION_RESERVED_BYTES, wipt.LP_PARTITION_RESERVED_BYTES + wipt.LP_METADATA_GEOMETRY_SIZE
+    with wipt.SuperImage(synthetic.write(tmp_path / "primary.img", _corrupt(data, primary + 44))) as super_image: # Falls back to the backup
+        assert super_image.partitions["vendor"]["size"] == len(contents["vendor"])
+    with pytest.raises(ValueError, match="geometry"): wipt.SuperImage(synthetic.write(tmp_path / "both.img", _corrupt(_corrupt(data, primary + 44), backup + 44)))
+
+def test_bad_header_checksum(tmp_path):
+    data, _ = synthetic.super_image(PARTITIONS)
+    backup = PRIMARY_HEADER + 2 * 4096 # slot_count 2, metadata_max_size 4096
+    with wipt.SuperImage(synthetic.write(tmp_path / "primary.img", _corrupt(data, PRIMARY_HEADER + 4))) as super_image:
+        assert "system" in super_image.partitions
+    with pytest.raises(ValueError, match="header"):
+        wipt.SuperImage(synthetic.write(tmp_path / "both.img", _corrupt(_corrupt(data, PRIMARY_HEADER + 4), backup + 4)))
+    with pytest.raises(ValueError, match="tables checksum"):
+        wipt.SuperImage(synthetic.write(tmp_path / "tables.img", _corrupt(_corrupt(data, PRIMARY_HEADER + 130), backup + 130)))
+
+def test_slot_out_of_range(image):
+    with pytest.raises(ValueError, match="Slot"): wipt.SuperImage(image[0], slot=2)
+
+def test_super_wrapped_in_sparse(tmp_path):
+    data, contents = synthetic.super_image(PARTITIONS)
+    path = synthetic.write(tmp_path / "super.sparse.img", synthetic.sparse_from_raw(data))
+    assert wipt.detect_format(path).format == "super"
+    with wipt.SuperImage(path) as super_image:
+        assert isinstance(super_image.view, wipt.SparseImageView)
+        assert io.BufferedReader(super_image.open("vendor")).read() == contents["vendor"]
+    wipt.handle_extract(_namespace(path, str(tmp_path / "out"), partitions="system,vendor"))
+    for name in ("system", "vendor"): assert (tmp_path / "out" / f"{name}.img").read_bytes() == contents[name]
@@ -0,0 +1,29 @@
+import synthetic
+import wipt
+
+PYTHON_ENGINES = {"CPIO_ENGINE": "python", "BOOTIMG_ENGINE": "python", "XZ_ENGINE": "python", "XZ_CACHE": False}
+
+def ramdisk_of(path):
+    with wipt.BootImage(path) as img:
+        data = img.sections["ramdisk"]
+        return wipt.RamdiskCpio.parse(wipt.decompress_ramdisk(wipt.detect_ramdisk_format(data), data))
+
+def test_variants_write_their_own_config_and_share_one_unpack(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path); synthetic.magisk_workspace(tmp_path)
+    image = synthetic.write(tmp_path / "boot.img", synthetic.boot_image(2))
+    variants = [(name, options) for name, options in wipt.build_patch_variants(PYTHON_ENGINES, ["keep_verity", "recovery_mode"])
+                if name in ("default", "keep_verity+recovery_mode")]
+    outputs = wipt.run_patch_variants(image, str(tmp_path / "out"), variants)
+    configs = [ramdisk_of(path).entries[".backup/.magisk"][5] for path in outputs]
+    assert configs[0] == b"KEEPVERITY=false\nKEEPFORCEENCRYPT=false\nRECOVERYMODE=false\n"
+    assert configs[1] == b"KEEPVERITY=true\nKEEPFORCEENCRYPT=false\nRECOVERYMODE=true\n"
+    log = capsys.readouterr().out
+    assert log.count("Unpack cache hit") == 1 and log.index("Variant keep_verity+recovery_mode") < log.index("Unpack cache hit")
+
+def test_variants_require_magisk(tmp_path, monkeypatch, capsys):
+    called = []
+    monkeypatch.setattr(wipt, "run_patch_variants", lambda *a, **k: called.append(a))
+    for patcher in (["--apatch"], []):
+        monkeypatch.setattr("sys.argv", ["wipt.py", "patch", "--input", "boot.img", "--output", str(tmp_path), *patcher, "--variants", "keep_verity"])
+        wipt.main()
+        assert not called and "add --magisk" in capsys.readouterr().out
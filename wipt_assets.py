@@ -0,0 +1,14 @@
+"""The Magisk asset manifest shared by setup.py (which writes it) and wipt.py (which reads it). Standard library
+only, so setup.py can use it before wipt.py's dependencies (lz4, ...) are installed."""
+import json
+import os
+
+ASSET_MANIFEST_NAME = "manifest.json" # Written by setup.py next to the assets it extracts from the Magisk APK
+
+def load_asset_manifest(assets_dir):
+    """setup.py's record of the extracted assets ({version, apk_sha256, archs, assets: name -> {arch, source, sha256,
+    size}}), or None when there is none (assets placed by hand)."""
+    try:
+        with open(os.path.join(assets_dir, ASSET_MANIFEST_NAME), encoding='utf-8') as f: manifest = json.load(f)
+    except (OSError, ValueError): return None
+    return manifest if isinstance(manifest, dict) and isinstance(manifest.get("assets"), dict) else None